@@ -0,0 +1,46 @@
+# ai_service/batch_store.py
+
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+class BatchJobStore:
+    """
+    离线批量任务记录（batch id -> 分析类型和各请求的 analysis_context），保存在 SQLite 中
+    多个 gunicorn worker 共享同一个数据库文件，服务重启后仍可查询已提交的任务
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    batch_id TEXT PRIMARY KEY,
+                    analysis_type TEXT NOT NULL,
+                    contexts TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        # 每次操作使用独立连接，sqlite3 连接不能跨线程共享
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def save(self, batch_id: str, analysis_type: str, contexts: list):
+        """记录已提交的批量任务"""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO batch_jobs (batch_id, analysis_type, contexts, created_at) VALUES (?, ?, ?, ?)",
+                (batch_id, analysis_type, json.dumps(contexts, ensure_ascii=False), time.time())
+            )
+
+    def get(self, batch_id: str):
+        """返回 (分析类型, analysis_context 列表)，未知的 batch id 返回 None"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT analysis_type, contexts FROM batch_jobs WHERE batch_id = ?", (batch_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
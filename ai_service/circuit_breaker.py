@@ -0,0 +1,86 @@
+# ai_service/circuit_breaker.py
+
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('ai_service')
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+class CircuitBreaker:
+    """
+    熔断器：时间窗口内失败次数达到阈值后打开，冷却期内直接拒绝请求而不再等待注定失败的AI调用；
+    冷却期结束后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, failure_window: float = 10.0, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.recovery_timeout = recovery_timeout
+        self._state = self.CLOSED
+        self._failures = deque()
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        """判断是否放行本次请求；半开状态下同一时间只放行一个探测请求"""
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.recovery_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+
+            if self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+
+            return True
+
+    def record_success(self):
+        """记录一次成功调用，关闭熔断器"""
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"✅ Circuit for {self.name} closed")
+            self._state = self.CLOSED
+            self._failures.clear()
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """记录一次失败调用，达到阈值（或半开探测失败）时打开熔断器"""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.HALF_OPEN:
+                self._open(now)
+                return
+
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.failure_window:
+                self._failures.popleft()
+            if self._state == self.CLOSED and len(self._failures) >= self.failure_threshold:
+                self._open(now)
+
+    def _open(self, now):
+        """打开熔断器（需在持有锁时调用）"""
+        self._state = self.OPEN
+        self._opened_at = now
+        self._failures.clear()
+        self._probe_in_flight = False
+        logger.warning(f"🚫 Circuit for {self.name} opened, failing fast for {self.recovery_timeout:.0f}s")
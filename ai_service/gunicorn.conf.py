@@ -0,0 +1,35 @@
+# ai_service/gunicorn.conf.py
+#
+# 生产环境启动方式（在 ai_service 目录下）：
+#   gunicorn -c gunicorn.conf.py server:app
+#
+# 默认使用 gevent worker，单个 worker 以协程并发处理大量等待AI响应的请求；
+# 如需改用线程 worker：
+#   AI_SERVICE_WORKER_CLASS=gthread gunicorn -c gunicorn.conf.py server:app
+#
+# preload_app 使 server 模块（模型管理器、prompt 常量、缓存等）只在主进程中导入一次，
+# 各 worker 通过 fork 以写时复制方式共享，而不是每个 worker 各自重新初始化
+
+import os
+
+worker_class = os.environ.get("AI_SERVICE_WORKER_CLASS", "gevent")
+
+if worker_class == "gevent":
+    # 必须在预加载应用（导入 ssl/socket/httpx）之前打补丁，
+    # 否则 OpenAI/Deepseek 请求使用的套接字仍是阻塞的
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get("AI_SERVICE_BIND", "0.0.0.0:5111")
+workers = int(os.environ.get("AI_SERVICE_WORKERS", "4"))
+# threads 仅对 gthread worker 生效，worker_connections 仅对 gevent worker 生效
+threads = int(os.environ.get("AI_SERVICE_THREADS", "16"))
+worker_connections = int(os.environ.get("AI_SERVICE_WORKER_CONNECTIONS", "1000"))
+preload_app = True
+# AI接口响应可能较慢，超时需大于提供商请求超时时间
+timeout = 120
+
+def post_fork(server, worker):
+    """fork 后重新启动日志线程（后台线程不会被子进程继承）"""
+    import server as ai_server
+    ai_server.start_log_listener()
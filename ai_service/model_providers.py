@@ -2,21 +2,53 @@
 
 import os
 import json
+import hashlib
+import threading
+import logging
+import httpx
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from cachetools import TTLCache
 from openai import OpenAI, OpenAIError
 from token_manager import TokenManager
+from rate_limiter import RateLimiter
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger('ai_service')
+
+# --- HTTP 连接池配置 ---
+# 复用 keep-alive 连接，避免并发请求时反复进行 TCP/TLS 握手
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50
+HTTP_KEEPALIVE_EXPIRY = 120.0
+
+def create_pooled_http_client():
+    """创建带连接池和 keep-alive 的 httpx 客户端（供 OpenAI SDK 使用）"""
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        http2=True
+    )
 
 class ModelProvider(ABC):
     """AI模型提供商的抽象基类"""
     
     @abstractmethod
-    def chat_completion(self, messages, max_tokens=100, temperature=0.3):
-        """生成聊天完成响应"""
+    def chat_completion(self, messages, max_tokens=100, temperature=0.3, response_format=None):
+        """生成聊天完成响应（response_format 用于请求结构化的JSON输出）"""
         pass
     
+    def stream_chat_completion(self, messages, max_tokens=100, temperature=0.3):
+        """流式生成聊天完成响应，逐段产出文本（默认实现一次性返回完整响应）"""
+        yield self.chat_completion(messages, max_tokens, temperature)
+    
     @abstractmethod
     def is_available(self):
         """检查模型是否可用"""
@@ -26,6 +58,11 @@ class ModelProvider(ABC):
     def get_provider_name(self):
         """获取提供商名称"""
         pass
+    
+    @abstractmethod
+    def get_model_name(self):
+        """获取规范的模型名称（用于选择 prompt 优化策略）"""
+        pass
 
 class OpenAIProvider(ModelProvider):
     """OpenAI模型提供商"""
@@ -38,13 +75,13 @@ class OpenAIProvider(ModelProvider):
         
         if self.api_key:
             try:
-                self.client = OpenAI(api_key=self.api_key)
-                print(f"OpenAI client initialized successfully with model: {self.model}")
+                self.client = OpenAI(api_key=self.api_key, http_client=create_pooled_http_client())
+                logger.info(f"OpenAI client initialized successfully with model: {self.model}")
             except Exception as e:
-                print(f"Error initializing OpenAI client: {e}")
+                logger.error(f"Error initializing OpenAI client: {e}")
                 self.client = None
     
-    def chat_completion(self, messages, max_tokens=100, temperature=0.3):
+    def chat_completion(self, messages, max_tokens=100, temperature=0.3, response_format=None):
         """使用OpenAI API生成响应"""
         if not self.client:
             raise Exception("OpenAI client not available")
@@ -54,18 +91,142 @@ class OpenAIProvider(ModelProvider):
         if not is_valid:
             raise Exception(f"Token limit exceeded: {recommendation}")
         
+        request_kwargs = {}
+        if response_format:
+            request_kwargs['response_format'] = response_format
+        
         try:
             response = self.client.chat.completions.create(
                 messages=messages,
                 model=self.model,
                 max_tokens=max_tokens,
                 temperature=temperature,
-                n=1
+                n=1,
+                **request_kwargs
             )
-            return response.choices[0].message.content.strip()
+            self._log_prompt_cache_usage(response.usage)
+            choice = response.choices[0]
+            if choice.finish_reason == "length":
+                logger.warning(f"OpenAI response truncated at max_tokens={max_tokens}, consider raising the budget")
+            return choice.message.content.strip()
         except OpenAIError as e:
             raise Exception(f"OpenAI API error: {str(e)}")
     
+    def _log_prompt_cache_usage(self, usage):
+        """记录服务端 prompt 缓存命中的 token 数（共享前缀达到 1024 tokens 后才会命中）"""
+        if not usage:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+        logger.debug(f"OpenAI prompt tokens: {usage.prompt_tokens}, cached: {cached_tokens}, completion tokens: {usage.completion_tokens}")
+    
+    def stream_chat_completion(self, messages, max_tokens=100, temperature=0.3):
+        """使用OpenAI API流式生成响应，逐段产出文本"""
+        if not self.client:
+            raise Exception("OpenAI client not available")
+        
+        is_valid, estimated_tokens, recommendation = self.token_manager.validate_prompt_size(messages)
+        if not is_valid:
+            raise Exception(f"Token limit exceeded: {recommendation}")
+        
+        try:
+            stream = self.client.chat.completions.create(
+                messages=messages,
+                model=self.model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                n=1,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except OpenAIError as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+    
+    def create_embedding(self, text, model="text-embedding-3-small"):
+        """计算文本的 embedding 向量"""
+        if not self.client:
+            raise Exception("OpenAI client not available")
+        
+        try:
+            response = self.client.embeddings.create(model=model, input=text)
+            return response.data[0].embedding
+        except OpenAIError as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+    
+    def submit_batch(self, batch_requests, max_tokens=100, temperature=0.3, response_format=None):
+        """
+        通过 OpenAI Batch API 提交离线批量请求（24小时内完成，费用为实时接口的一半）
+        
+        batch_requests 为 (custom_id, messages) 元组列表，返回 batch id
+        """
+        if not self.client:
+            raise Exception("OpenAI client not available")
+        
+        lines = []
+        for custom_id, messages in batch_requests:
+            body = {
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature
+            }
+            if response_format:
+                body["response_format"] = response_format
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }, ensure_ascii=False))
+        
+        try:
+            input_file = self.client.files.create(
+                file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+                purpose="batch"
+            )
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            return batch.id
+        except OpenAIError as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+    
+    def get_batch_results(self, batch_id):
+        """
+        查询批量请求状态，完成时返回 {custom_id: 响应内容}
+        
+        Returns:
+            (status, results)
+        """
+        if not self.client:
+            raise Exception("OpenAI client not available")
+        
+        try:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status != "completed" or not batch.output_file_id:
+                return batch.status, None
+            
+            output = self.client.files.content(batch.output_file_id).text
+        except OpenAIError as e:
+            raise Exception(f"OpenAI API error: {str(e)}")
+        
+        results = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            choices = (response.get('body') or {}).get('choices') or []
+            if choices:
+                results[item['custom_id']] = choices[0]['message']['content'].strip()
+            else:
+                results[item['custom_id']] = None
+        return batch.status, results
+    
     def is_available(self):
         """检查OpenAI是否可用"""
         return self.client is not None
@@ -73,6 +234,10 @@ class OpenAIProvider(ModelProvider):
     def get_provider_name(self):
         """获取提供商名称"""
         return f"OpenAI ({self.model})"
+    
+    def get_model_name(self):
+        """获取规范的模型名称"""
+        return self.model
 
 class DeepseekProvider(ModelProvider):
     """Deepseek模型提供商"""
@@ -109,41 +274,20 @@ class DeepseekProvider(ModelProvider):
         retries = Retry(total=3,
                         backoff_factor=0.3,
                         status_forcelist=[500, 502, 503, 504])
-        # 将重试策略应用到所有https请求
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        # 将重试策略应用到所有https请求，并扩大连接池以便并发请求复用 keep-alive 连接
+        self.session.mount('https://', HTTPAdapter(max_retries=retries,
+                                                   pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                                   pool_maxsize=HTTP_MAX_KEEPALIVE_CONNECTIONS))
 
-        print(f"Deepseek provider initialized with model: {self.model}")
-        print(f"Token manager configured - Max tokens: {self.token_manager.max_tokens}, Available: {self.token_manager.available_tokens}")
+        logger.info(f"Deepseek provider initialized with model: {self.model}")
+        logger.info(f"Token manager configured - Max tokens: {self.token_manager.max_tokens}, Available: {self.token_manager.available_tokens}")
     
-    def chat_completion(self, messages, max_tokens=100, temperature=0.3):
-        """使用Deepseek API生成响应"""
-        
-        # 🚀 新增：Token 大小验证和优化
-        is_valid, estimated_tokens, recommendation = self.token_manager.validate_prompt_size(messages)
+    def chat_completion(self, messages, max_tokens=100, temperature=0.3, response_format=None):
+        """使用Deepseek API生成响应（该接口不保证支持 response_format，JSON 输出依赖 prompt 约束）"""
         
-        if not is_valid:
-            print(f"⚠️ Token limit exceeded for {self.model_name}: {estimated_tokens} tokens, {recommendation}")
-            
-            # 尝试自动优化 prompt
-            optimized_messages = self._optimize_messages(messages)
-            
-            # 重新验证优化后的消息
-            is_valid_after_opt, new_estimated_tokens, new_recommendation = self.token_manager.validate_prompt_size(optimized_messages)
-            
-            if is_valid_after_opt:
-                print(f"✅ Successfully optimized prompt: {estimated_tokens} -> {new_estimated_tokens} tokens")
-                messages = optimized_messages
-            else:
-                # 如果优化后仍然超限，抛出详细错误
-                raise Exception(f"Token limit exceeded even after optimization. {new_recommendation} Original: {estimated_tokens} tokens, Optimized: {new_estimated_tokens} tokens, Limit: {self.token_manager.available_tokens} tokens.")
-        else:
-            print(f"✅ Token validation passed for {self.model_name}: {estimated_tokens}/{self.token_manager.available_tokens} tokens")
+        messages = self._prepare_messages(messages)
         
-        headers = {
-            'accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.api_key}'
-        }
+        headers = self._build_headers()
         
         payload = {
             "model": self.model,
@@ -186,7 +330,7 @@ class DeepseekProvider(ModelProvider):
                         return choice['content'].strip()
                     
                     # 如果没有找到预期的内容，记录警告并返回整个choice
-                    print(f"WARNING: Unexpected choice format for {self.model_name}: {choice}")
+                    logger.warning(f"Unexpected choice format for {self.model_name}: {choice}")
                     return f"AI返回了预期外的格式，请检查API响应。"
                 else:
                     raise Exception(f"Invalid response format from Deepseek API: missing choices. Response: {result}")
@@ -208,6 +352,87 @@ class DeepseekProvider(ModelProvider):
         except json.JSONDecodeError as e:
             raise Exception(f"Failed to parse Deepseek API response: {str(e)}")
     
+    def _prepare_messages(self, messages):
+        """
+        验证消息的 token 大小，超限时尝试自动优化，优化后仍超限则抛出异常
+        """
+        # 🚀 新增：Token 大小验证和优化
+        is_valid, estimated_tokens, recommendation = self.token_manager.validate_prompt_size(messages)
+        
+        if not is_valid:
+            logger.warning(f"⚠️ Token limit exceeded for {self.model_name}: {estimated_tokens} tokens, {recommendation}")
+            
+            # 尝试自动优化 prompt
+            optimized_messages = self._optimize_messages(messages)
+            
+            # 重新验证优化后的消息
+            is_valid_after_opt, new_estimated_tokens, new_recommendation = self.token_manager.validate_prompt_size(optimized_messages)
+            
+            if is_valid_after_opt:
+                logger.info(f"✅ Successfully optimized prompt: {estimated_tokens} -> {new_estimated_tokens} tokens")
+                return optimized_messages
+            else:
+                # 如果优化后仍然超限，抛出详细错误
+                raise Exception(f"Token limit exceeded even after optimization. {new_recommendation} Original: {estimated_tokens} tokens, Optimized: {new_estimated_tokens} tokens, Limit: {self.token_manager.available_tokens} tokens.")
+        else:
+            logger.info(f"✅ Token validation passed for {self.model_name}: {estimated_tokens}/{self.token_manager.available_tokens} tokens")
+        
+        return messages
+    
+    def _build_headers(self):
+        """构建 Deepseek API 请求头"""
+        return {
+            'accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}'
+        }
+    
+    def stream_chat_completion(self, messages, max_tokens=100, temperature=0.3):
+        """使用Deepseek API流式生成响应，逐段产出文本"""
+        messages = self._prepare_messages(messages)
+        
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "stream": True,
+            "temperature": temperature
+        }
+        
+        try:
+            with self.session.post(
+                self.base_url,
+                headers=self._build_headers(),
+                json=payload,
+                timeout=60,
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    raise Exception(f"Deepseek API error: {response.status_code} - {response.text}")
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    # SSE 格式：每个事件为 "data: {...}"，以 "data: [DONE]" 结束
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    
+                    chunk = json.loads(data)
+                    choices = chunk.get('choices') or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get('delta') or {}
+                    # Deepseek R1 模型使用 reasoning_content 字段
+                    text = delta.get('reasoning_content') or delta.get('content')
+                    if text:
+                        yield text
+                    
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Network error when calling Deepseek API: {str(e)}")
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse Deepseek API response: {str(e)}")
+    
     def _optimize_messages(self, messages):
         """
         优化消息内容以减少 token 使用
@@ -352,12 +577,16 @@ class DeepseekProvider(ModelProvider):
             self.chat_completion(test_messages, max_tokens=5)
             return True
         except Exception as e:
-            print(f"Deepseek availability check failed: {e}")
+            logger.warning(f"Deepseek availability check failed: {e}")
             return False
     
     def get_provider_name(self):
         """获取提供商名称"""
         return f"Deepseek ({self.model_name})"
+    
+    def get_model_name(self):
+        """获取规范的模型名称"""
+        return self.model_name
 
     def get_token_manager(self):
         """获取 token 管理器"""
@@ -366,14 +595,50 @@ class DeepseekProvider(ModelProvider):
 class ModelManager:
     """AI模型管理器，负责选择和切换不同的模型提供商"""
     
+    # 响应缓存配置：相同模型 + 相同 prompt 的请求直接返回缓存结果
+    RESPONSE_CACHE_SIZE = 4096
+    RESPONSE_CACHE_TTL = 3600  # 秒
+    
+    # 主动限流配置（每分钟请求数 / 每分钟 token 数），可通过环境变量调整
+    RATE_LIMIT_RPM = int(os.environ.get("AI_RATE_LIMIT_RPM", "3000"))
+    RATE_LIMIT_TPM = int(os.environ.get("AI_RATE_LIMIT_TPM", "2000000"))
+    
+    # 同时进行中的AI调用上限（与 keep-alive 连接池大小一致）及单次调用的等待超时
+    MAX_INFLIGHT_CALLS = HTTP_MAX_KEEPALIVE_CONNECTIONS
+    CALL_TIMEOUT = 100  # 秒
+    
+    # 熔断配置：10 秒内失败 5 次后打开，30 秒后放行探测请求
+    CIRCUIT_FAILURE_THRESHOLD = 5
+    CIRCUIT_FAILURE_WINDOW = 10.0  # 秒
+    CIRCUIT_RECOVERY_TIMEOUT = 30.0  # 秒
+    
     def __init__(self, preferred_provider="openai"):
         self.providers = {}
         self.current_provider = None
         self.preferred_provider = preferred_provider
+        self._response_cache = TTLCache(maxsize=self.RESPONSE_CACHE_SIZE, ttl=self.RESPONSE_CACHE_TTL)
+        self._response_cache_lock = threading.Lock()
+        self.rate_limiter = RateLimiter(rpm=self.RATE_LIMIT_RPM, tpm=self.RATE_LIMIT_TPM)
+        # 所有AI调用在共享线程池中执行，无论 Flask 并发多高，进行中的请求数都不超过池大小
+        self._call_executor = ThreadPoolExecutor(max_workers=self.MAX_INFLIGHT_CALLS, thread_name_prefix='ai-call')
+        # 进行中的相同请求（缓存键 -> Future），后到的相同请求等待已有调用的结果而不是重复调用
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
         
         # 初始化提供商
         self._init_providers()
         
+        # 每个提供商独立熔断，切换到其他提供商不受已熔断提供商的影响
+        self._circuit_breakers = {
+            provider: CircuitBreaker(
+                provider.get_provider_name(),
+                failure_threshold=self.CIRCUIT_FAILURE_THRESHOLD,
+                failure_window=self.CIRCUIT_FAILURE_WINDOW,
+                recovery_timeout=self.CIRCUIT_RECOVERY_TIMEOUT
+            )
+            for provider in self.providers.values()
+        }
+        
         # 选择首选提供商
         self._select_provider()
     
@@ -384,34 +649,34 @@ class ModelManager:
             openai_provider = OpenAIProvider()
             if openai_provider.is_available():
                 self.providers["openai"] = openai_provider
-                print("✅ OpenAI provider is available")
+                logger.info("✅ OpenAI provider is available")
             else:
-                print("❌ OpenAI provider is not available")
+                logger.warning("❌ OpenAI provider is not available")
         except Exception as e:
-            print(f"❌ Failed to initialize OpenAI: {e}")
+            logger.warning(f"❌ Failed to initialize OpenAI: {e}")
         
         # 初始化Deepseek V3
         try:
             deepseek_v3_provider = DeepseekProvider("deepseek-v3")
             self.providers["deepseek-v3"] = deepseek_v3_provider
-            print("✅ Deepseek V3 provider initialized")
+            logger.info("✅ Deepseek V3 provider initialized")
         except Exception as e:
-            print(f"❌ Failed to initialize Deepseek V3: {e}")
+            logger.warning(f"❌ Failed to initialize Deepseek V3: {e}")
         
         # 初始化Deepseek R1
         try:
             deepseek_r1_provider = DeepseekProvider("deepseek-r1")
             self.providers["deepseek-r1"] = deepseek_r1_provider
-            print("✅ Deepseek R1 provider initialized")
+            logger.info("✅ Deepseek R1 provider initialized")
         except Exception as e:
-            print(f"❌ Failed to initialize Deepseek R1: {e}")
+            logger.warning(f"❌ Failed to initialize Deepseek R1: {e}")
     
     def _select_provider(self):
         """选择可用的提供商"""
         # 尝试使用首选提供商
         if self.preferred_provider in self.providers:
             self.current_provider = self.providers[self.preferred_provider]
-            print(f"🎯 Using preferred provider: {self.current_provider.get_provider_name()}")
+            logger.info(f"🎯 Using preferred provider: {self.current_provider.get_provider_name()}")
             return
         
         # 如果首选不可用，按优先级顺序选择
@@ -424,28 +689,142 @@ class ModelManager:
                 try:
                     if provider.is_available() or provider_name.startswith("deepseek"):
                         self.current_provider = provider
-                        print(f"🔄 Fallback to provider: {self.current_provider.get_provider_name()}")
+                        logger.info(f"🔄 Fallback to provider: {self.current_provider.get_provider_name()}")
                         return
                 except:
                     continue
         
-        print("❌ No AI providers are available")
+        logger.warning("❌ No AI providers are available")
         self.current_provider = None
     
     def get_current_provider(self):
         """获取当前使用的提供商"""
         return self.current_provider
     
+    def get_embedding_provider(self):
+        """获取支持 embedding 接口的提供商，目前仅 OpenAI 支持"""
+        return self.providers.get("openai")
+    
+    def get_batch_provider(self):
+        """获取支持离线批量接口（Batch API）的提供商，目前仅 OpenAI 支持"""
+        return self.providers.get("openai")
+    
+    def get_canonical_model_name(self, default="deepseek-v3"):
+        """获取当前提供商的规范模型名称（如 'gpt-4.1-mini'、'deepseek-r1'）"""
+        if not self.current_provider:
+            return default
+        return self.current_provider.get_model_name()
+    
     def is_available(self):
         """检查是否有可用的AI服务"""
         return self.current_provider is not None
     
-    def chat_completion(self, messages, max_tokens=100, temperature=0.3):
-        """使用当前提供商生成聊天完成响应"""
+    def chat_completion(self, messages, max_tokens=100, temperature=0.3, response_format=None):
+        """使用当前提供商生成聊天完成响应（相同请求命中缓存时不再调用AI接口）"""
         if not self.current_provider:
             raise Exception("No AI provider is available")
         
-        return self.current_provider.chat_completion(messages, max_tokens, temperature)
+        provider = self.current_provider
+        cache_key = self._response_cache_key(provider.get_model_name(), messages, max_tokens, temperature, response_format)
+        with self._response_cache_lock:
+            cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Response cache hit for %s", provider.get_model_name())
+            return cached
+        
+        with self._inflight_lock:
+            shared = self._inflight.get(cache_key)
+            is_owner = shared is None
+            if is_owner:
+                shared = Future()
+                self._inflight[cache_key] = shared
+        
+        if not is_owner:
+            logger.debug("Joining in-flight request for %s", provider.get_model_name())
+            return self._wait_for_call(shared)
+        
+        try:
+            circuit_breaker = self._check_circuit(provider)
+            self._acquire_rate_limit(messages, max_tokens)
+            call = self._call_executor.submit(provider.chat_completion, messages, max_tokens, temperature, response_format)
+            try:
+                response = self._wait_for_call(call)
+            except Exception:
+                circuit_breaker.record_failure()
+                raise
+            circuit_breaker.record_success()
+            if response:
+                with self._response_cache_lock:
+                    self._response_cache[cache_key] = response
+            shared.set_result(response)
+            return response
+        except Exception as e:
+            shared.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(cache_key, None)
+    
+    def _check_circuit(self, provider):
+        """提供商熔断时直接抛出 CircuitOpenError，否则返回其熔断器"""
+        circuit_breaker = self._circuit_breakers[provider]
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError(f"{provider.get_provider_name()} is temporarily unavailable after repeated errors")
+        return circuit_breaker
+    
+    def _wait_for_call(self, future):
+        """等待AI调用完成，超时则抛出异常"""
+        try:
+            return future.result(timeout=self.CALL_TIMEOUT)
+        except FutureTimeoutError:
+            raise Exception(f"AI request timed out after {self.CALL_TIMEOUT}s")
+    
+    def stream_chat_completion(self, messages, max_tokens=100, temperature=0.3):
+        """使用当前提供商流式生成响应，逐段产出文本；完整响应写入缓存，命中缓存时一次性返回"""
+        if not self.current_provider:
+            raise Exception("No AI provider is available")
+        
+        provider = self.current_provider
+        cache_key = self._response_cache_key(provider.get_model_name(), messages, max_tokens, temperature)
+        with self._response_cache_lock:
+            cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+        
+        circuit_breaker = self._check_circuit(provider)
+        self._acquire_rate_limit(messages, max_tokens)
+        parts = []
+        try:
+            for text in provider.stream_chat_completion(messages, max_tokens, temperature):
+                parts.append(text)
+                yield text
+        except GeneratorExit:
+            # 客户端中途断开时提供商仍在正常响应，按成功处理以免半开探测一直占位
+            circuit_breaker.record_success()
+            raise
+        except Exception:
+            circuit_breaker.record_failure()
+            raise
+        circuit_breaker.record_success()
+        
+        response = ''.join(parts).strip()
+        if response:
+            with self._response_cache_lock:
+                self._response_cache[cache_key] = response
+    
+    def _acquire_rate_limit(self, messages, max_tokens):
+        """按估算的 token 数（prompt 字符数/4 + max_tokens）获取限流配额"""
+        est_tokens = sum(len(message.get('content') or '') for message in messages) // 4 + max_tokens
+        waited = self.rate_limiter.acquire(est_tokens)
+        if waited > 0:
+            logger.info(f"⏳ Rate limiter delayed request by {waited:.2f}s")
+    
+    @staticmethod
+    def _response_cache_key(model_name, messages, max_tokens, temperature, response_format=None):
+        """根据模型和请求参数生成缓存键"""
+        raw = json.dumps([model_name, messages, max_tokens, temperature, response_format], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
     
     def get_provider_status(self):
         """获取所有提供商的状态信息"""
@@ -455,7 +834,8 @@ class ModelManager:
                 {
                     "name": name,
                     "display_name": provider.get_provider_name(),
-                    "is_current": provider == self.current_provider
+                    "is_current": provider == self.current_provider,
+                    "circuit_state": self._circuit_breakers[provider].state
                 }
                 for name, provider in self.providers.items()
             ]
@@ -471,5 +851,5 @@ class ModelManager:
         self.current_provider = self.providers[provider_name]
         new_provider = self.current_provider.get_provider_name()
         
-        print(f"🔄 Switched from {old_provider} to {new_provider}")
+        logger.info(f"🔄 Switched from {old_provider} to {new_provider}")
         return new_provider 
\ No newline at end of file
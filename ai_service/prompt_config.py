@@ -1,7 +1,13 @@
 # ai_service/prompt_config.py
+import logging
+import textwrap
 from datetime import datetime
+from functools import partial
+from os.path import basename, splitext
 from token_manager import TokenManager
 
+logger = logging.getLogger('ai_service')
+
 def get_file_change_type_description(type_char):
     """根据文件变更类型字符返回中文描述"""
     status_map = {
@@ -13,6 +19,10 @@ def get_file_change_type_description(type_char):
     }
     return status_map.get(type_char, '未知')
 
+def split_file_path(file_path):
+    """返回文件路径对应的 (文件名, 小写扩展名)，没有扩展名时扩展名为空字符串"""
+    return basename(file_path), splitext(file_path)[1][1:].lower()
+
 def generate_stats_from_payload(file_changes, is_comparison=False):
     """从文件变更数据生成统计信息字符串"""
     stats = {'added': 0, 'modified': 0, 'deleted': 0, 'renamed': 0, 'untracked': 0}
@@ -38,29 +48,101 @@ def generate_stats_from_payload(file_changes, is_comparison=False):
         total_changes = stats['added'] + stats['modified'] + stats['deleted'] + stats['renamed']
         return f"此提交共涉及 {total_changes} 个文件变更：{'，'.join(parts)}。"
 
+# 单文件差异分析的系统提示：固定的分析要求放在最前面，所有请求共享相同的前缀，
+# 便于提供商的服务端 prompt 缓存命中；文件信息和 diff 等可变内容只出现在用户消息中
+ANALYZE_DIFF_SYSTEM_PROMPT = textwrap.dedent("""
+    你是一个专业的Git代码分析助手。用户会提供一个文件的路径、文件名、文件类型和Git Diff内容，请分析变更内容并提供简洁的中文总结。
+
+    请按以下格式回答（不超过80字）：
+    文件名: [文件简介]。[主要变更内容]。
+
+    要求：
+    1. 先简要说明文件用途
+    2. 重点描述变更的功能性影响，而非技术细节
+    3. 使用简洁的中文表达
+    4. 避免使用"这个文件"等指代词
+    5. 回答以用户提供的文件名开头
+    """).strip()
+
+# 单文件差异分析的用户消息模板（模块加载时去除缩进，请求时只需一次 format_map）
+_ANALYZE_DIFF_PROMPT = textwrap.dedent("""
+    文件信息：
+    - 文件路径: {file_path}
+    - 文件名: {file_name}
+    - 文件类型: {file_extension}
+
+    Git Diff内容：
+    ```diff
+    {file_diff}
+    ```
+    """).strip()
+
 def build_analyze_diff_prompt(file_path, file_extension, file_name, file_diff):
-    """构建单文件差异分析的提示"""
-    return f"""
-            请分析以下Git差异文件的变更内容，并提供简洁的中文总结。
+    """构建单文件差异分析的用户消息（分析要求见 ANALYZE_DIFF_SYSTEM_PROMPT）"""
+    return _ANALYZE_DIFF_PROMPT.format_map({
+        "file_path": file_path,
+        "file_extension": file_extension,
+        "file_diff": file_diff,
+        "file_name": file_name,
+    })
+
+# 多文件批量分析结果的 JSON Schema
+BATCH_ANALYZE_DIFF_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "index": {"type": "integer"},
+                    "summary": {"type": "string"}
+                },
+                "required": ["index", "summary"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
 
-            文件信息：
-            - 文件路径: {file_path}
-            - 文件类型: {file_extension}
+BATCH_ANALYZE_DIFF_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "batch_analyze_diff", "schema": BATCH_ANALYZE_DIFF_SCHEMA, "strict": True}
+}
 
-            Git Diff内容：
-            ```diff
-            {file_diff}
-            ```
+def build_batch_analyze_diff_prompt(file_entries):
+    """构建多文件差异批量分析的提示（一次请求分析多个文件）
 
-            请按以下格式回答（不超过80字）：
-            {file_name}: [文件简介]。[主要变更内容]。
+    file_entries 为字典列表，每项包含 file_path、file_extension、file_name、file_diff
+    """
+    prompt = f"""请分析以下 {len(file_entries)} 个Git差异文件的变更内容，并为每个文件分别提供简洁的中文总结。
+"""
+    for index, entry in enumerate(file_entries):
+        prompt += f"""
+文件 {index}：
+- 文件路径: {entry['file_path']}
+- 文件类型: {entry['file_extension']}
 
-            要求：
-            1. 先简要说明文件用途
-            2. 重点描述变更的功能性影响，而非技术细节
-            3. 使用简洁的中文表达
-            4. 避免使用"这个文件"等指代词
-            """
+```diff
+{entry['file_diff']}
+```
+"""
+
+    prompt += """
+每个文件的总结格式为（不超过80字）：
+文件名: [文件简介]。[主要变更内容]。
+
+要求：
+1. 先简要说明文件用途
+2. 重点描述变更的功能性影响，而非技术细节
+3. 使用简洁的中文表达
+4. 避免使用"这个文件"等指代词
+5. 严格返回有效的JSON格式，不要添加```json```代码块包装或其他内容：
+{"results": [{"index": 0, "summary": "..."}, {"index": 1, "summary": "..."}]}
+6. results 中必须包含每个文件的 index，与上面的文件编号一一对应"""
+    return prompt
 
 def build_comprehensive_commit_analysis_prompt(payload, model_name='deepseek-v3'):
     """构建Git提交的综合分析提示，支持 token 优化"""
@@ -73,7 +155,7 @@ def build_comprehensive_commit_analysis_prompt(payload, model_name='deepseek-v3'
     
     # 记录优化信息
     if len(optimized_files) < len(file_analysis_data):
-        print(f"🔧 Token optimization: {len(file_analysis_data)} -> {len(optimized_files)} files for {model_name}")
+        logger.info(f"🔧 Token optimization: {len(file_analysis_data)} -> {len(optimized_files)} files for {model_name}")
     
     stats = generate_stats_from_payload(optimized_files, is_comparison=False)
 
@@ -328,16 +410,12 @@ def build_file_history_analysis_prompt(payload):
 - 使用结构化的JSON格式回答，包含summary、evolutionPattern、keyChanges、recommendations四个字段"""
     return prompt
 
-def build_enhanced_file_history_prompt(prompt):
-    """为文件历史分析构建增强的提示"""
-    return f"""
-请对以下文件的版本演进历史进行深度分析：
-
-{prompt}
+# 文件历史分析的系统提示：固定的输出格式要求作为所有请求共享的前缀
+FILE_HISTORY_SYSTEM_PROMPT = """你是一个专业的代码演进分析师。请对用户提供的文件版本演进历史进行深度分析。
 
 要求：严格按照以下JSON格式返回，不要添加任何其他内容：
 
-{{
+{
     "summary": "该文件从开始到现在的整体演进总结，包括主要发展趋势和目的",
     "evolutionPattern": "文件的演进模式分析，包括开发活跃度、变更频率、贡献者协作模式等",
     "keyChanges": [
@@ -350,7 +428,7 @@ def build_enhanced_file_history_prompt(prompt):
         "第二个优化建议",
         "第三个优化建议"
     ]
-}}
+}
 
 注意事项：
 1. 必须严格返回有效的JSON格式
@@ -358,11 +436,78 @@ def build_enhanced_file_history_prompt(prompt):
 3. summary和evolutionPattern为字符串，不超过80字
 4. 使用中文回答，语言专业且易懂
 5. 不要添加```json```代码块包装
-6. 基于实际提交历史提供有价值的分析
-"""
+6. 基于实际提交历史提供有价值的分析"""
+
+# 文件历史分析结果的 JSON Schema（用于支持 Structured Outputs 的模型，保证返回合法JSON）
+FILE_HISTORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "evolutionPattern": {"type": "string"},
+        "keyChanges": {"type": "array", "items": {"type": "string"}},
+        "recommendations": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["summary", "evolutionPattern", "keyChanges", "recommendations"],
+    "additionalProperties": False
+}
+
+FILE_HISTORY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "file_history", "schema": FILE_HISTORY_SCHEMA, "strict": True}
+}
+
+def build_enhanced_file_history_prompt(prompt):
+    """为文件历史分析构建用户消息（输出格式要求见 FILE_HISTORY_SYSTEM_PROMPT）"""
+    return f"请对以下文件的版本演进历史进行深度分析：\n\n{prompt}"
+
+# 文件版本比较分析结果的 JSON Schema
+FILE_VERSION_COMPARISON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "changeType": {"type": "string"},
+        "impactAnalysis": {"type": "string"},
+        "keyModifications": {"type": "array", "items": {"type": "string"}},
+        "recommendations": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["summary", "changeType", "impactAnalysis", "keyModifications", "recommendations"],
+    "additionalProperties": False
+}
+
+FILE_VERSION_COMPARISON_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "file_version_comparison", "schema": FILE_VERSION_COMPARISON_SCHEMA, "strict": True}
+}
+
+# 文件版本比较分析的系统提示：固定的输出格式要求作为所有请求共享的前缀
+FILE_VERSION_COMPARISON_SYSTEM_PROMPT = """你是一个专业的代码版本比较分析师。请对用户提供的文件版本比较进行深度分析，提供精准、专业的版本差异分析。
+
+请按以下JSON格式提供分析结果：
+
+{
+  "summary": "这次文件变更的简要总结（不超过100字）",
+  "changeType": "变更类型描述（如：功能增强、bug修复、重构等）",
+  "impactAnalysis": "变更影响分析（对系统、用户、性能等方面的影响）",
+  "keyModifications": [
+    "第一个关键修改点",
+    "第二个关键修改点",
+    "第三个关键修改点"
+  ],
+  "recommendations": [
+    "第一个建议或注意事项",
+    "第二个建议或注意事项"
+  ]
+}
+
+要求：
+1. 严格返回有效的JSON格式，不要添加其他内容
+2. 所有字段都用中文填写
+3. keyModifications和recommendations数组每项不超过50字
+4. 分析要专业且有价值
+5. 基于实际的代码变更提供见解"""
 
 def build_file_version_comparison_prompt(payload):
-    """构建文件版本比较分析的提示"""
+    """构建文件版本比较分析的用户消息（输出格式要求见 FILE_VERSION_COMPARISON_SYSTEM_PROMPT）"""
     file_path = payload.get('filePath', '未知文件')
     from_hash = payload.get('fromHash', '未知版本')
     to_hash = payload.get('toHash', '未知版本')
@@ -370,8 +515,7 @@ def build_file_version_comparison_prompt(payload):
     content_before = payload.get('contentBefore', '')
     content_after = payload.get('contentAfter', '')
     
-    file_name = file_path.split('/')[-1] if '/' in file_path else file_path
-    file_extension = file_name.split('.')[-1].lower() if '.' in file_name else ''
+    file_name, file_extension = split_file_path(file_path)
 
     prompt = f"""请对以下文件版本比较进行深度分析：
 
@@ -399,28 +543,32 @@ Git Diff内容：
 {content_after[:200]}{'...' if len(content_after) > 200 else ''}
 ```
 """
-    prompt += """
-请按以下JSON格式提供分析结果：
+    return prompt
 
-{
-  "summary": "这次文件变更的简要总结（不超过100字）",
-  "changeType": "变更类型描述（如：功能增强、bug修复、重构等）",
-  "impactAnalysis": "变更影响分析（对系统、用户、性能等方面的影响）",
-  "keyModifications": [
-    "第一个关键修改点",
-    "第二个关键修改点",
-    "第三个关键修改点"
-  ],
-  "recommendations": [
-    "第一个建议或注意事项",
-    "第二个建议或注意事项"
-  ]
+# --- 综合分析 prompt 构建器 ---
+# 综合分析使用的系统提示（与模型和分析类型无关，只构建一次）
+COMPREHENSIVE_SYSTEM_PROMPT = "你是一个专业的Git代码分析助手。请根据用户的要求，提供精准、专业的代码变更分析。如果要求HTML格式，请确保返回有效的HTML片段。"
+
+COMPREHENSIVE_PROMPT_BUILDERS = {
+    'comprehensive_commit_analysis': build_comprehensive_commit_analysis_prompt,
+    'comprehensive_uncommitted_analysis': build_comprehensive_uncommitted_analysis_prompt,
+    'comprehensive_comparison_analysis': build_comprehensive_comparison_prompt,
 }
 
-要求：
-1. 严格返回有效的JSON格式，不要添加其他内容
-2. 所有字段都用中文填写
-3. keyModifications和recommendations数组每项不超过50字
-4. 分析要专业且有价值
-5. 基于实际的代码变更提供见解"""
-    return prompt 
\ No newline at end of file
+# 在模块加载时为每个已知模型预先绑定 model_name，请求时只需一次字典查找
+_BUILDERS_BY_MODEL = {
+    model: {
+        context: partial(builder, model_name=model)
+        for context, builder in COMPREHENSIVE_PROMPT_BUILDERS.items()
+    }
+    for model in TokenManager.MODEL_LIMITS
+}
+
+def get_comprehensive_prompt_builder(analysis_context, model_name):
+    """获取已绑定模型名称的综合分析 prompt 构建器，未知分析类型返回 None"""
+    builders = _BUILDERS_BY_MODEL.get(model_name)
+    if builders is not None:
+        return builders.get(analysis_context)
+    
+    builder = COMPREHENSIVE_PROMPT_BUILDERS.get(analysis_context)
+    return partial(builder, model_name=model_name) if builder else None
@@ -0,0 +1,52 @@
+# ai_service/rate_limiter.py
+
+import time
+import threading
+
+class RateLimiter:
+    """
+    令牌桶限流器，同时限制每分钟请求数（RPM）和每分钟 token 数（TPM）
+    在调用AI接口前主动等待，避免触发提供商的 429 限流后再退避重试
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        # 每秒补充的请求数和 token 数
+        self._request_rate = rpm / 60.0
+        self._token_rate = tpm / 60.0
+        self._request_bucket = float(rpm)
+        self._token_bucket = float(tpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """按经过的时间补充令牌（需在持有锁时调用）"""
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        self._request_bucket = min(self.rpm, self._request_bucket + elapsed * self._request_rate)
+        self._token_bucket = min(self.tpm, self._token_bucket + elapsed * self._token_rate)
+
+    def acquire(self, est_tokens: int) -> float:
+        """
+        等待直到有足够的请求和 token 配额，返回实际等待的秒数
+        """
+        # 单个请求超过整个桶容量时按桶容量计，避免永远等待
+        est_tokens = min(max(est_tokens, 0), self.tpm)
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._request_bucket >= 1 and self._token_bucket >= est_tokens:
+                    self._request_bucket -= 1
+                    self._token_bucket -= est_tokens
+                    return waited
+
+                request_wait = max(0.0, (1 - self._request_bucket) / self._request_rate)
+                token_wait = max(0.0, (est_tokens - self._token_bucket) / self._token_rate)
+                wait = max(request_wait, token_wait)
+
+            time.sleep(wait)
+            waited += wait
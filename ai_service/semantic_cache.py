@@ -0,0 +1,111 @@
+# ai_service/semantic_cache.py
+
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger('ai_service')
+
+try:
+    import numpy as np
+    import faiss
+except ImportError:  # 未安装 faiss/numpy 时语义缓存不可用
+    np = None
+    faiss = None
+
+class SemanticCache:
+    """
+    基于向量相似度的分析结果缓存
+    对规范化后的 diff 计算 embedding，在 FAISS 内积索引中查找余弦相似度超过阈值的已缓存结果
+    """
+
+    def __init__(self, dim: int = 1536, threshold: float = 0.97, persist_path: str = None):
+        self.dim = dim
+        self.threshold = threshold
+        self.persist_path = persist_path
+        self._lock = threading.Lock()
+        self._payloads = []
+        self._index = None
+
+        if faiss is None:
+            logger.info("faiss/numpy not installed, semantic cache disabled")
+            return
+
+        self._index = faiss.IndexFlatIP(dim)
+        if persist_path:
+            self._load()
+
+    def is_enabled(self) -> bool:
+        return self._index is not None
+
+    def _to_vector(self, embedding):
+        """转换为 L2 归一化的 float32 行向量，使内积等于余弦相似度"""
+        vec = np.asarray(embedding, dtype='float32').reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def lookup(self, embedding, match=None):
+        """
+        查找最相似的缓存结果，相似度低于阈值或 match(payload) 不成立时返回 None
+        """
+        if not self.is_enabled():
+            return None
+
+        vec = self._to_vector(embedding)
+        with self._lock:
+            if self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(vec, 1)
+            score, idx = float(scores[0, 0]), int(ids[0, 0])
+            if idx < 0 or score < self.threshold:
+                return None
+            payload = self._payloads[idx]
+
+        if match is not None and not match(payload):
+            return None
+        logger.debug("Semantic cache hit (similarity %.4f)", score)
+        return payload
+
+    def add(self, embedding, payload):
+        """添加一条缓存结果"""
+        if not self.is_enabled():
+            return
+
+        vec = self._to_vector(embedding)
+        with self._lock:
+            self._index.add(vec)
+            self._payloads.append(payload)
+
+    def save(self):
+        """将索引和结果持久化到 persist_path"""
+        if not self.is_enabled() or not self.persist_path:
+            return
+
+        with self._lock:
+            os.makedirs(self.persist_path, exist_ok=True)
+            faiss.write_index(self._index, os.path.join(self.persist_path, 'index.faiss'))
+            with open(os.path.join(self.persist_path, 'payloads.json'), 'w', encoding='utf-8') as f:
+                json.dump(self._payloads, f, ensure_ascii=False)
+        logger.info(f"Semantic cache saved: {len(self._payloads)} entries")
+
+    def _load(self):
+        """从 persist_path 加载已持久化的索引"""
+        index_path = os.path.join(self.persist_path, 'index.faiss')
+        payloads_path = os.path.join(self.persist_path, 'payloads.json')
+        if not (os.path.exists(index_path) and os.path.exists(payloads_path)):
+            return
+
+        try:
+            index = faiss.read_index(index_path)
+            with open(payloads_path, 'r', encoding='utf-8') as f:
+                payloads = json.load(f)
+            if index.d != self.dim or index.ntotal != len(payloads):
+                raise ValueError("index and payloads do not match")
+        except Exception as e:
+            logger.warning(f"Failed to load semantic cache from {self.persist_path}: {e}")
+            return
+
+        self._index = index
+        self._payloads = payloads
+        logger.info(f"Semantic cache loaded: {len(payloads)} entries")
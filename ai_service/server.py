@@ -1,34 +1,223 @@
 # ai_service/server.py
 
+import io
 import os
+import gzip
 import json
-from flask import Flask, request, jsonify
+import atexit
+import hashlib
+import threading
+import queue
+import logging
+import logging.handlers
+from typing import List, Optional
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import msgspec
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
+from flask_compress import Compress
+from cachetools import TTLCache
 import prompt_config as prompts
 from model_providers import ModelManager
+from token_manager import truncate_middle
+from semantic_cache import SemanticCache
+from batch_store import BatchJobStore
+
+# --- 日志配置 ---
+# 日志通过 QueueHandler 交给后台线程写出，避免请求线程阻塞在 stdout 上
+# 日志级别可通过 LOG_LEVEL 环境变量调整（例如 DEBUG 时会输出完整的AI响应）
+logger = logging.getLogger('ai_service')
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+log_listener = None
+
+def start_log_listener():
+    """
+    创建日志队列并启动后台写日志线程
+    线程不会被 fork 继承，gunicorn 预加载模式下每个 worker 需在 fork 后重新调用
+    """
+    global log_listener
+    log_queue = queue.Queue(-1)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+
+start_log_listener()
+atexit.register(lambda: log_listener.stop())
+# ------------------------------------
+
+class GzipRequestMiddleware:
+    """解压 Content-Encoding: gzip 的请求体，使大型 diff 负载可以压缩后上传"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                body = environ['wsgi.input'].read(length) if length > 0 else environ['wsgi.input'].read()
+                body = gzip.decompress(body)
+            except (OSError, EOFError, ValueError) as e:
+                logger.warning(f"Failed to decompress gzip request body: {e}")
+                start_response('400 BAD REQUEST', [('Content-Type', 'application/json')])
+                return [b'{"error": "Invalid gzip request body"}']
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
 
 app = Flask(__name__)
 CORS(app)
 
+def ojsonify(obj, status=200):
+    """使用 orjson 序列化 JSON 响应（比 flask.jsonify 更快，且中文不转义为 \\uXXXX）"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# --- 响应压缩 ---
+# 综合分析返回的HTML和JSON响应较大，按客户端 Accept-Encoding 协商 br/gzip 压缩
+# SSE 流式响应不压缩，否则压缩缓冲会延迟每个事件的发送
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
+app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
+
+# --- 请求体结构 ---
+# 使用 msgspec 在一次解码中完成 JSON 解析和字段类型校验，替代逐个字段的 dict 检查
+class DiffRequest(msgspec.Struct):
+    """单文件差异分析请求（综合分析时 file_diff 为序列化后的分析负载）"""
+    analysis_context: str
+    file_diff: Optional[str]
+    content_before: Optional[str] = None
+    content_after: Optional[str] = None
+
+class BatchRequest(msgspec.Struct):
+    """批量差异分析请求"""
+    files: List[DiffRequest]
+
+_diff_request_decoder = msgspec.json.Decoder(DiffRequest)
+_batch_request_decoder = msgspec.json.Decoder(BatchRequest)
+# ------------------------------------
+
+# --- 分析结果缓存 ---
+# 以 (端点, 文件, 内容, 模型, prompt 版本) 的哈希为键缓存完整的分析结果，
+# 相同请求在端点入口直接返回，连 prompt 构建也一并跳过；修改 prompt 时需更新版本号
+ANALYSIS_CACHE_PROMPT_VERSION = "v2"
+analysis_cache = TTLCache(maxsize=10_000, ttl=3600)
+analysis_cache_lock = threading.RLock()
+
+def _cache_key(*parts):
+    """将多个字符串拼接后计算 SHA-256 作为缓存键"""
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+def normalize_diff(diff_content):
+    """
+    规范化 diff 内容用于缓存键和 embedding：去掉 index 行和 @@ 行号信息，统一换行符并去除行尾空白，
+    仅有位置偏移等表面差异的 diff 得到相同的结果（发送给模型的仍是原始 diff）
+    """
+    lines = []
+    for line in diff_content.splitlines():
+        if line.startswith('@@'):
+            lines.append('@@')
+        elif line.startswith('index '):
+            continue
+        else:
+            lines.append(line.rstrip())
+    return '\n'.join(lines)
+
+def get_cached_analysis(key):
+    """读取缓存的分析结果，未命中返回 None"""
+    with analysis_cache_lock:
+        return analysis_cache.get(key)
+
+def set_cached_analysis(key, analysis):
+    """缓存分析结果"""
+    with analysis_cache_lock:
+        analysis_cache[key] = analysis
+# ------------------------------------
+
+# --- 语义缓存 ---
+# 精确缓存未命中时，用 embedding 查找内容几乎相同的已分析 diff（需要 OpenAI 提供商和 faiss）
+# 设置 SEMANTIC_CACHE_PATH 后，退出时会将索引持久化到该目录
+semantic_cache = SemanticCache(persist_path=os.environ.get("SEMANTIC_CACHE_PATH"))
+atexit.register(semantic_cache.save)
+
+def get_diff_embedding(normalized_diff):
+    """计算规范化 diff 的 embedding，语义缓存不可用或调用失败时返回 None"""
+    embedding_provider = model_manager.get_embedding_provider()
+    if not semantic_cache.is_enabled() or not embedding_provider:
+        return None
+    try:
+        return embedding_provider.create_embedding(normalized_diff)
+    except Exception as e:
+        logger.warning(f"Failed to compute diff embedding, skipping semantic cache: {e}")
+        return None
+# ------------------------------------
+
+# 单文件差异分析时 diff 内容的 token 上限，超出部分保留首尾、省略中间
+ANALYZE_DIFF_MAX_DIFF_TOKENS = 4000
+# 单文件总结不超过80字（约120 tokens），temperature=0 使相同输入的输出稳定，提高缓存命中率
+ANALYZE_DIFF_MAX_TOKENS = 140
+ANALYZE_DIFF_TEMPERATURE = 0
+# 文件历史、文件版本比较的用户消息 token 上限
+FILE_ANALYSIS_MAX_PROMPT_TOKENS = 6000
+# 综合分析的用户消息 token 上限（构建器已按模型上下文压缩文件数据，此处兜底限制超大上下文模型的输入成本）
+COMPREHENSIVE_MAX_PROMPT_TOKENS = 24000
+
+# --- 批量分析并发配置 ---
+# 批量分析中的各文件并发调用AI接口，线程数上限用于避免超出提供商的速率限制
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "10"))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_CONCURRENCY, thread_name_prefix='batch')
+# ------------------------------------
+
 # --- 初始化AI模型管理器 ---
 # 从环境变量读取首选的AI提供商，默认使用deepseek-v3
 preferred_ai_provider = os.environ.get("PREFERRED_AI_PROVIDER", "deepseek-v3")
 model_manager = ModelManager(preferred_provider=preferred_ai_provider)
-print(f"🚀 AI Service started with preferred provider: {preferred_ai_provider}")
+logger.info(f"🚀 AI Service started with preferred provider: {preferred_ai_provider}")
 # ------------------------------------
 
+# AI服务不可用时各分析端点返回的降级响应
+AI_UNAVAILABLE_ANALYSIS = {
+    "analysis": {
+        "summary": "AI分析服务暂时不可用，请检查AI服务配置。",
+    }
+}
+AI_UNAVAILABLE_BATCH = {
+    "analyses": [],
+    "summary": "AI分析服务暂时不可用，请检查AI服务配置。"
+}
+
+def require_ai_service(unavailable_response):
+    """路由装饰器：没有可用的AI提供商时直接返回降级响应，端点本身只需处理正常流程"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not model_manager.is_available():
+                return ojsonify(unavailable_response)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查端点"""
     if model_manager.is_available():
         provider_info = model_manager.get_current_provider().get_provider_name()
-        return jsonify({
+        return ojsonify({
             "status": "healthy", 
             "ai_service": "available",
             "current_provider": provider_info
         }), 200
     else:
-        return jsonify({
+        return ojsonify({
             "status": "degraded", 
             "ai_service": "unavailable",
             "current_provider": None
@@ -39,9 +228,9 @@ def get_providers():
     """获取所有AI提供商的状态信息"""
     try:
         status = model_manager.get_provider_status()
-        return jsonify(status), 200
+        return ojsonify(status), 200
     except Exception as e:
-        return jsonify({"error": f"Failed to get provider status: {str(e)}"}), 500
+        return ojsonify({"error": f"Failed to get provider status: {str(e)}"}), 500
 
 @app.route('/providers/switch', methods=['POST'])
 def switch_provider():
@@ -49,138 +238,158 @@ def switch_provider():
     try:
         data = request.get_json()
         if not data or 'provider' not in data:
-            return jsonify({"error": "Missing 'provider' in request"}), 400
+            return ojsonify({"error": "Missing 'provider' in request"}), 400
         
         provider_name = data['provider']
         new_provider = model_manager.switch_provider(provider_name)
         
-        return jsonify({
+        return ojsonify({
             "message": f"Successfully switched to {new_provider}",
             "current_provider": new_provider
         }), 200
         
     except ValueError as e:
-        return jsonify({"error": str(e)}), 400
+        return ojsonify({"error": str(e)}), 400
     except Exception as e:
-        return jsonify({"error": f"Failed to switch provider: {str(e)}"}), 500
+        return ojsonify({"error": f"Failed to switch provider: {str(e)}"}), 500
+
+def stream_analysis_response(messages, max_tokens, temperature, analysis_context):
+    """以 Server-Sent Events 形式返回流式AI响应：每段为 {"delta": ...}，出错时为 {"error": ...}，以 [DONE] 结束"""
+    def generate():
+        try:
+            for text in model_manager.stream_chat_completion(messages, max_tokens=max_tokens, temperature=temperature):
+                yield f"data: {orjson.dumps({'delta': text}).decode('utf-8')}\n\n"
+        except Exception as e:
+            logger.error(f"AI API streaming error for {analysis_context}: {e}")
+            yield f"data: {orjson.dumps({'error': f'AI分析暂时不可用：{str(e)}'}).decode('utf-8')}\n\n"
+        yield "data: [DONE]\n\n"
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.route('/analyze_diff', methods=['POST'])
+@require_ai_service(AI_UNAVAILABLE_ANALYSIS)
 def analyze_diff():
     """Analyzes the diff data using available AI provider."""
-    if not model_manager.is_available():
-        return jsonify({
-            "analysis": {
-                "summary": "AI分析服务暂时不可用，请检查AI服务配置。",
-            }
-        })
-
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Missing data in request"}), 400
+        diff_request = _diff_request_decoder.decode(request.get_data())
         
         # 检查是否是综合分析请求
-        if 'analysis_context' in data and data['analysis_context'] in ['comprehensive_commit_analysis', 'comprehensive_comparison_analysis', 'comprehensive_uncommitted_analysis']:
-            return handle_comprehensive_analysis(data)
+        if diff_request.analysis_context in prompts.COMPREHENSIVE_PROMPT_BUILDERS:
+            return handle_comprehensive_analysis(diff_request.analysis_context, diff_request.file_diff or '{}')
         
         # 原有的单文件分析逻辑
-        if 'file_diff' not in data or 'analysis_context' not in data:
-            return jsonify({"error": "Missing or invalid data in request (requires analysis_context and file_diff)"}), 400
-        
-        analysis_context = data['analysis_context']
-        file_diff = data['file_diff']
+        analysis_context = diff_request.analysis_context
+        file_diff = diff_request.file_diff
         
         # 检查diff内容是否为空
         if not file_diff or file_diff.strip() == '':
-            return jsonify({
+            return ojsonify({
                 "analysis": {
                     "summary": "文件无实质性变更。"
                 }
             })
 
-        print(f"Received request to analyze diff for: {analysis_context}")
+        logger.info(f"Received request to analyze diff for: {analysis_context}")
         analysis_context = analysis_context.strip()
         
+        streaming = request.args.get('stream') == '1'
+        normalized_diff = normalize_diff(file_diff)
+        cache_key = _cache_key('analyze_diff', analysis_context, normalized_diff, model_manager.get_canonical_model_name(), ANALYSIS_CACHE_PROMPT_VERSION)
+        cached = get_cached_analysis(cache_key)
+        if cached is not None and not streaming:
+            return ojsonify(cached)
+        
         # 获取文件类型和扩展名（如果是文件路径的话）
-        file_extension = analysis_context.split('.')[-1].lower() if '.' in analysis_context else ''
-        context_name = analysis_context.split('/')[-1]
+        context_name, file_extension = prompts.split_file_path(analysis_context)
+        
+        # 精确缓存未命中时查找语义相似的结果（总结以文件名开头，只复用同名文件的结果）
+        embedding = None if streaming else get_diff_embedding(normalized_diff)
+        if embedding is not None:
+            similar = semantic_cache.lookup(embedding, match=lambda payload: payload.get('file_name') == context_name)
+            if similar is not None:
+                result = similar['result']
+                set_cached_analysis(cache_key, result)
+                return ojsonify(result)
+        
+        # 改进的提示词，更加具体和有针对性
+        prompt = prompts.build_analyze_diff_prompt(analysis_context, file_extension, context_name, truncate_middle(file_diff, ANALYZE_DIFF_MAX_DIFF_TOKENS))
+        messages = [
+            {
+                "role": "system",
+                "content": prompts.ANALYZE_DIFF_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ]
+        
+        # ?stream=1 时以 SSE 形式逐段返回总结，客户端无需等待完整响应
+        if streaming:
+            return stream_analysis_response(messages, max_tokens=ANALYZE_DIFF_MAX_TOKENS, temperature=ANALYZE_DIFF_TEMPERATURE, analysis_context=analysis_context)
         
         # --- AI API Call --- 
         try:
-            # 改进的提示词，更加具体和有针对性
-            prompt = prompts.build_analyze_diff_prompt(analysis_context, file_extension, context_name, file_diff)
-
             # 使用模型管理器调用AI API
             ai_summary = model_manager.chat_completion(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
-                max_tokens=100,
-                temperature=0.3
+                messages=messages,
+                max_tokens=ANALYZE_DIFF_MAX_TOKENS,
+                temperature=ANALYZE_DIFF_TEMPERATURE
             )
 
-            print(f"AI Summary for {analysis_context}: {ai_summary}")
+            logger.debug("AI Summary for %s: %s", analysis_context, ai_summary)
 
         except Exception as e:
-            print(f"AI API error for {analysis_context}: {e}")
+            logger.error(f"AI API error for {analysis_context}: {e}")
             ai_summary = f"AI分析暂时不可用：{str(e)}"
+            return ojsonify({
+                "analysis": {
+                    "summary": ai_summary,
+                }
+            })
         # -----------------------
 
-        return jsonify({
+        result = {
             "analysis": {
                 "summary": ai_summary,
             }
-        })
-
-    except json.JSONDecodeError:
-        return jsonify({"error": "Invalid JSON format"}), 400
+        }
+        set_cached_analysis(cache_key, result)
+        if embedding is not None:
+            semantic_cache.add(embedding, {"file_name": context_name, "result": result})
+        return ojsonify(result)
+
+    except msgspec.ValidationError as e:
+        return ojsonify({"error": f"Missing or invalid data in request: {e}"}), 400
+    except msgspec.DecodeError:
+        return ojsonify({"error": "Invalid JSON format"}), 400
     except Exception as e:
-        print(f"Error processing request: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+        logger.error(f"Error processing request: {e}")
+        return ojsonify({"error": "An internal server error occurred"}), 500
 
-def handle_comprehensive_analysis(data):
+def handle_comprehensive_analysis(analysis_context_marker, payload_str):
     """处理通用的综合性分析请求"""
     try:
-        analysis_context_marker = data.get('analysis_context')
-        payload_str = data.get('file_diff', '{}')
         payload = json.loads(payload_str)
 
         # 🚀 新增：获取当前模型名称以便优化 prompt
-        current_model_name = 'deepseek-v3'  # 默认值
-        if model_manager.current_provider:
-            provider_name = model_manager.current_provider.get_provider_name()
-            if 'OpenAI' in provider_name and 'gpt-4.1' in provider_name.lower():
-                current_model_name = 'gpt-4.1-mini' if 'mini' in provider_name.lower() else 'gpt-4.1'
-            elif 'Deepseek' in provider_name:
-                if 'deepseek-r1' in provider_name.lower():
-                    current_model_name = 'deepseek-r1'
-                else:
-                    current_model_name = 'deepseek-v3'
-
-        prompt_builders = {
-            'comprehensive_commit_analysis': lambda payload: prompts.build_comprehensive_commit_analysis_prompt(payload, current_model_name),
-            'comprehensive_uncommitted_analysis': lambda payload: prompts.build_comprehensive_uncommitted_analysis_prompt(payload, current_model_name),
-            'comprehensive_comparison_analysis': lambda payload: prompts.build_comprehensive_comparison_prompt(payload, current_model_name)
-        }
+        current_model_name = model_manager.get_canonical_model_name()
 
-        builder = prompt_builders.get(analysis_context_marker)
+        builder = prompts.get_comprehensive_prompt_builder(analysis_context_marker, current_model_name)
         
         if not builder:
-            return jsonify({"error": f"Invalid comprehensive analysis type: {analysis_context_marker}"}), 400
+            return ojsonify({"error": f"Invalid comprehensive analysis type: {analysis_context_marker}"}), 400
             
-        prompt = builder(payload)
+        prompt = truncate_middle(builder(payload), COMPREHENSIVE_MAX_PROMPT_TOKENS)
         
-        print(f"🔧 Using model-optimized prompt for {current_model_name}, context: {analysis_context_marker}")
+        logger.info(f"🔧 Using model-optimized prompt for {current_model_name}, context: {analysis_context_marker}")
         
         # 使用模型管理器进行分析
         ai_summary = model_manager.chat_completion(
             messages=[
                 {
                     "role": "system",
-                    "content": "你是一个专业的Git代码分析助手。请根据用户的要求，提供精准、专业的代码变更分析。如果要求HTML格式，请确保返回有效的HTML片段。"
+                    "content": prompts.COMPREHENSIVE_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
@@ -191,17 +400,17 @@ def handle_comprehensive_analysis(data):
             temperature=0.3
         )
         
-        return jsonify({
+        return ojsonify({
             "analysis": {
                 "summary": ai_summary,
             }
         })
     except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error parsing comprehensive analysis payload: {e}")
-        return jsonify({"error": "Invalid payload for comprehensive analysis"}), 400
+        logger.error(f"Error parsing comprehensive analysis payload: {e}")
+        return ojsonify({"error": "Invalid payload for comprehensive analysis"}), 400
     except Exception as e:
-        print(f"AI API error during comprehensive analysis: {e}")
-        return jsonify({
+        logger.error(f"AI API error during comprehensive analysis: {e}")
+        return ojsonify({
             "analysis": {
                 "summary": "AI分析时遇到API错误。",
             }
@@ -209,7 +418,7 @@ def handle_comprehensive_analysis(data):
 
 def generate_fallback_analysis(error_message="分析时发生未知错误。"):
     """生成降级分析响应"""
-    return json.dumps({
+    return orjson.dumps({
         "summary": error_message,
         "evolutionPattern": "文件演进模式分析基于提交历史，显示开发活跃度和变更频率。",
         "keyChanges": [
@@ -222,97 +431,128 @@ def generate_fallback_analysis(error_message="分析时发生未知错误。"):
             "定期进行重构优化",
             "加强文档维护"
         ]
-    }, ensure_ascii=False)
+    }).decode('utf-8')
+
+FILE_HISTORY_MAX_TOKENS = 260
+FILE_HISTORY_TEMPERATURE = 0
+FILE_VERSION_COMPARISON_MAX_TOKENS = 300
+FILE_VERSION_COMPARISON_TEMPERATURE = 0.3
+
+def build_file_history_messages(payload):
+    """根据文件历史负载构建AI请求消息"""
+    # 在后端构建提示
+    base_prompt = prompts.build_file_history_analysis_prompt(payload)
+    
+    # 优化后的文件历史分析提示词
+    enhanced_prompt = prompts.build_enhanced_file_history_prompt(base_prompt)
+    
+    return [
+        {
+            "role": "system",
+            "content": prompts.FILE_HISTORY_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": truncate_middle(enhanced_prompt, FILE_ANALYSIS_MAX_PROMPT_TOKENS),
+        }
+    ]
+
+def build_file_version_comparison_messages(payload):
+    """根据文件版本比较负载构建AI请求消息"""
+    # 构建版本比较分析提示
+    prompt = truncate_middle(prompts.build_file_version_comparison_prompt(payload), FILE_ANALYSIS_MAX_PROMPT_TOKENS)
+    
+    return [
+        {
+            "role": "system",
+            "content": prompts.FILE_VERSION_COMPARISON_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": prompt,
+        }
+    ]
+
+def validate_file_history_summary(ai_summary, analysis_context):
+    """
+    验证文件历史分析返回的是包含必需字段的有效JSON，否则返回降级分析
+    OpenAI 通过 Structured Outputs 保证格式；其他提供商只受 prompt 约束，仍需校验
+    """
+    try:
+        test_parse = json.loads(ai_summary)
+        if not all(key in test_parse for key in ['summary', 'evolutionPattern', 'keyChanges', 'recommendations']):
+            raise ValueError("Missing required fields in AI response")
+    except (json.JSONDecodeError, ValueError):
+        logger.warning(f"Invalid JSON response for {analysis_context}, using fallback")
+        return generate_fallback_analysis("AI返回的数据格式不正确，已使用默认分析。")
+    return ai_summary
 
 @app.route('/analyze_file_history', methods=['POST'])
+@require_ai_service(AI_UNAVAILABLE_ANALYSIS)
 def analyze_file_history():
     """专门处理文件历史分析的端点"""
-    if not model_manager.is_available():
-        return jsonify({
-            "analysis": {
-                "summary": "AI分析服务暂时不可用，请检查AI服务配置。",
-            }
-        })
-
     try:
         data = request.get_json()
         if not data:
-            return jsonify({"error": "Missing data in request"}), 400
+            return ojsonify({"error": "Missing data in request"}), 400
         
         # 接收原始数据负载，而不是预构建的提示
         payload_str = data.get('file_diff', '{}') 
-        payload = json.loads(payload_str)
         analysis_context = data.get('analysis_context', '未知文件')
+        
+        cache_key = _cache_key('analyze_file_history', analysis_context, payload_str, model_manager.get_canonical_model_name(), ANALYSIS_CACHE_PROMPT_VERSION)
+        cached = get_cached_analysis(cache_key)
+        if cached is not None:
+            return ojsonify(cached)
+        
+        payload = json.loads(payload_str)
 
         if not payload.get('commits'):
-            return jsonify({"error": "Missing commits data for file history analysis"}), 400
+            return ojsonify({"error": "Missing commits data for file history analysis"}), 400
         
-        print(f"Received file history analysis request for: {analysis_context}")
+        logger.info(f"Received file history analysis request for: {analysis_context}")
         
-        # 在后端构建提示
-        base_prompt = prompts.build_file_history_analysis_prompt(payload)
-        
-        # 优化后的文件历史分析提示词
-        enhanced_prompt = prompts.build_enhanced_file_history_prompt(base_prompt)
-
         try:
             ai_summary = model_manager.chat_completion(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一个专业的代码演进分析师。请严格按照用户要求的JSON格式回答，不要添加任何额外的文本或格式化。"
-                    },
-                    {
-                        "role": "user",
-                        "content": enhanced_prompt,
-                    }
-                ],
-                max_tokens=400,
-                temperature=0.2
+                messages=build_file_history_messages(payload),
+                max_tokens=FILE_HISTORY_MAX_TOKENS,
+                temperature=FILE_HISTORY_TEMPERATURE,
+                response_format=prompts.FILE_HISTORY_RESPONSE_FORMAT
             )
 
-            print(f"File History Analysis Raw Response for {analysis_context}: {ai_summary}")
+            logger.debug("File History Analysis Raw Response for %s: %s", analysis_context, ai_summary)
+            validated_summary = validate_file_history_summary(ai_summary, analysis_context)
 
-            # 尝试验证返回的是有效的JSON
-            try:
-                test_parse = json.loads(ai_summary)
-                if not all(key in test_parse for key in ['summary', 'evolutionPattern', 'keyChanges', 'recommendations']):
-                    raise ValueError("Missing required fields in AI response")
-            except (json.JSONDecodeError, ValueError):
-                print(f"Invalid JSON response for {analysis_context}, using fallback")
-                ai_summary = generate_fallback_analysis("AI返回的数据格式不正确，已使用默认分析。")
+            # 只缓存通过校验的AI结果，降级分析不缓存
+            if validated_summary is ai_summary:
+                set_cached_analysis(cache_key, {"analysis": {"summary": ai_summary}})
+            ai_summary = validated_summary
 
         except Exception as e:
-            print(f"AI API error for file history analysis {analysis_context}: {e}")
+            logger.error(f"AI API error for file history analysis {analysis_context}: {e}")
             ai_summary = generate_fallback_analysis(f"AI分析时发生错误：{str(e)}")
 
-        return jsonify({
+        return ojsonify({
             "analysis": {
                 "summary": ai_summary,
             }
         })
 
     except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error parsing file history analysis payload: {e}")
-        return jsonify({"error": "Invalid payload for file history analysis"}), 400
+        logger.error(f"Error parsing file history analysis payload: {e}")
+        return ojsonify({"error": "Invalid payload for file history analysis"}), 400
     except Exception as e:
-        print(f"Unexpected error during file history analysis: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+        logger.error(f"Unexpected error during file history analysis: {e}")
+        return ojsonify({"error": "An internal server error occurred"}), 500
 
 @app.route('/analyze_file_version_comparison', methods=['POST'])
+@require_ai_service(AI_UNAVAILABLE_ANALYSIS)
 def analyze_file_version_comparison():
     """处理文件版本比较分析的端点"""
-    if not model_manager.is_available():
-        return jsonify({
-            "analysis": {
-                "summary": "AI分析服务暂时不可用，请检查AI服务配置。",
-            }
-        })
-
     try:
         data = request.get_json()
         if not data:
-            return jsonify({"error": "Missing data in request"}), 400
+            return ojsonify({"error": "Missing data in request"}), 400
         
         # 接收原始数据负载
         payload_str = data.get('file_diff', '{}') 
@@ -320,132 +560,325 @@ def analyze_file_version_comparison():
         analysis_context = data.get('analysis_context', '未知文件')
 
         if not payload.get('contentBefore') and not payload.get('contentAfter'):
-            return jsonify({"error": "Missing file content data for version comparison"}), 400
+            return ojsonify({"error": "Missing file content data for version comparison"}), 400
         
-        print(f"Received file version comparison request for: {analysis_context}")
+        logger.info(f"Received file version comparison request for: {analysis_context}")
         
-        # 构建版本比较分析提示
-        prompt = prompts.build_file_version_comparison_prompt(payload)
-
         try:
             ai_summary = model_manager.chat_completion(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一个专业的代码版本比较分析师。请提供精准、专业的版本差异分析。"
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-                ],
-                max_tokens=300,
-                temperature=0.3
+                messages=build_file_version_comparison_messages(payload),
+                max_tokens=FILE_VERSION_COMPARISON_MAX_TOKENS,
+                temperature=FILE_VERSION_COMPARISON_TEMPERATURE,
+                response_format=prompts.FILE_VERSION_COMPARISON_RESPONSE_FORMAT
             )
 
-            print(f"File Version Comparison Analysis for {analysis_context}: {ai_summary}")
+            logger.debug("File Version Comparison Analysis for %s: %s", analysis_context, ai_summary)
 
         except Exception as e:
-            print(f"AI API error for file version comparison {analysis_context}: {e}")
+            logger.error(f"AI API error for file version comparison {analysis_context}: {e}")
             ai_summary = f"AI分析时发生错误：{str(e)}"
 
-        return jsonify({
+        return ojsonify({
             "analysis": {
                 "summary": ai_summary,
             }
         })
 
     except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error parsing file version comparison payload: {e}")
-        return jsonify({"error": "Invalid payload for file version comparison"}), 400
+        logger.error(f"Error parsing file version comparison payload: {e}")
+        return ojsonify({"error": "Invalid payload for file version comparison"}), 400
+    except Exception as e:
+        logger.error(f"Unexpected error during file version comparison: {e}")
+        return ojsonify({"error": "An internal server error occurred"}), 500
+
+def build_analyze_diff_messages(analysis_context, file_diff):
+    """构建单文件差异分析的AI请求消息"""
+    context_name, file_extension = prompts.split_file_path(analysis_context)
+    prompt = prompts.build_analyze_diff_prompt(analysis_context, file_extension, context_name, truncate_middle(file_diff, ANALYZE_DIFF_MAX_DIFF_TOKENS))
+    
+    return [
+        {
+            "role": "system",
+            "content": prompts.ANALYZE_DIFF_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": prompt,
+        }
+    ]
+
+def analyze_batch_file(file_data):
+    """分析批量请求中的单个文件，返回该文件的分析结果条目"""
+    analysis_context = file_data.analysis_context
+    file_diff = file_data.file_diff
+    
+    # 跳过空的diff
+    if not file_diff or file_diff.strip() == '':
+        return {
+            "analysis_context": analysis_context,
+            "analysis": {
+                "summary": "文件无实质性变更。"
+            }
+        }
+    
+    try:
+        # AI分析
+        ai_summary = model_manager.chat_completion(
+            messages=build_analyze_diff_messages(analysis_context, file_diff),
+            max_tokens=ANALYZE_DIFF_MAX_TOKENS,
+            temperature=ANALYZE_DIFF_TEMPERATURE
+        )
+        
+        return {
+            "analysis_context": analysis_context,
+            "analysis": {
+                "summary": ai_summary,
+            }
+        }
+        
     except Exception as e:
-        print(f"Unexpected error during file version comparison: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+        logger.error(f"Error analyzing {analysis_context}: {e}")
+        return {
+            "analysis_context": analysis_context,
+            "analysis": {
+                "summary": f"分析失败：{str(e)}"
+            }
+        }
+
+def analyze_batch_combined(file_entries):
+    """在一次AI请求中分析多个文件，返回 {下标: 总结}，缺失或解析失败的文件不包含在结果中"""
+    prompt_entries = []
+    for file_data in file_entries:
+        analysis_context = file_data.analysis_context
+        file_name, file_extension = prompts.split_file_path(analysis_context)
+        prompt_entries.append({
+            "file_path": analysis_context,
+            "file_extension": file_extension,
+            "file_name": file_name,
+            "file_diff": truncate_middle(file_data.file_diff, ANALYZE_DIFF_MAX_DIFF_TOKENS),
+        })
+    
+    prompt = prompts.build_batch_analyze_diff_prompt(prompt_entries)
+    
+    try:
+        ai_response = model_manager.chat_completion(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            max_tokens=ANALYZE_DIFF_MAX_TOKENS * len(file_entries) + 50,
+            temperature=ANALYZE_DIFF_TEMPERATURE,
+            response_format=prompts.BATCH_ANALYZE_DIFF_RESPONSE_FORMAT
+        )
+        parsed = json.loads(ai_response)
+        results = parsed.get('results', []) if isinstance(parsed, dict) else []
+    except Exception as e:
+        logger.warning(f"Combined batch analysis failed, falling back to per-file requests: {e}")
+        return {}
+    
+    summaries = {}
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        index = item.get('index')
+        summary = item.get('summary')
+        if isinstance(index, int) and 0 <= index < len(file_entries) and summary:
+            summaries[index] = summary
+    return summaries
 
 @app.route('/analyze_batch', methods=['POST'])
+@require_ai_service(AI_UNAVAILABLE_BATCH)
 def analyze_batch():
     """批量分析多个文件的差异"""
-    if not model_manager.is_available():
-        return jsonify({
-            "analyses": [],
-            "summary": "AI分析服务暂时不可用，请检查AI服务配置。"
-        })
-
     try:
-        data = request.get_json()
-        if not data or 'files' not in data:
-            return jsonify({"error": "Missing 'files' in request"}), 400
+        files = _batch_request_decoder.decode(request.get_data()).files
         
-        files = data['files']
-        if not isinstance(files, list):
-            return jsonify({"error": "'files' must be an array"}), 400
+        # 同一文件的相同变更（规范化后的 diff 相同）只分析一次，结果复用到所有重复项
+        duplicates = {}
+        for index, file_data in enumerate(files):
+            key = _cache_key(file_data.analysis_context, normalize_diff(file_data.file_diff or ''))
+            duplicates.setdefault(key, []).append(index)
+        unique_files = [files[indices[0]] for indices in duplicates.values()]
         
-        analyses = []
+        # 有实质变更的文件合并为一次AI请求，节省重复的提示词和网络往返
+        pending = [
+            index for index, file_data in enumerate(unique_files)
+            if file_data.file_diff and file_data.file_diff.strip() != ''
+        ]
+        summaries = {}
+        if len(pending) > 1:
+            combined = analyze_batch_combined([unique_files[index] for index in pending])
+            summaries = {pending[position]: summary for position, summary in combined.items()}
         
-        for file_data in files:
-            if 'analysis_context' not in file_data or 'file_diff' not in file_data:
-                continue
-            
-            analysis_context = file_data['analysis_context']
-            file_diff = file_data['file_diff']
-            
-            # 跳过空的diff
-            if not file_diff or file_diff.strip() == '':
-                analyses.append({
-                    "analysis_context": analysis_context,
-                    "analysis": {
-                        "summary": "文件无实质性变更。"
-                    }
-                })
-                continue
-            
-            try:
-                # 获取文件类型和扩展名
-                file_extension = analysis_context.split('.')[-1].lower() if '.' in analysis_context else ''
-                context_name = analysis_context.split('/')[-1]
-                
-                # 构建提示词
-                prompt = prompts.build_analyze_diff_prompt(analysis_context, file_extension, context_name, file_diff)
-                
-                # AI分析
-                ai_summary = model_manager.chat_completion(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": prompt,
-                        }
-                    ],
-                    max_tokens=100,
-                    temperature=0.3
-                )
-                
-                analyses.append({
-                    "analysis_context": analysis_context,
-                    "analysis": {
-                        "summary": ai_summary,
-                    }
-                })
-                
-            except Exception as e:
-                print(f"Error analyzing {analysis_context}: {e}")
-                analyses.append({
-                    "analysis_context": analysis_context,
-                    "analysis": {
-                        "summary": f"分析失败：{str(e)}"
-                    }
-                })
-        
-        return jsonify({
+        # 未被合并请求覆盖的文件（包括空diff）逐个并发分析，map 保证结果顺序与请求顺序一致
+        remaining = [index for index in range(len(unique_files)) if index not in summaries]
+        for index, analysis in zip(remaining, batch_executor.map(analyze_batch_file, [unique_files[i] for i in remaining])):
+            summaries[index] = analysis['analysis']['summary']
+        
+        file_summaries = {}
+        for unique_index, indices in enumerate(duplicates.values()):
+            for index in indices:
+                file_summaries[index] = summaries[unique_index]
+        
+        analyses = [
+            {
+                "analysis_context": file_data.analysis_context,
+                "analysis": {
+                    "summary": file_summaries[index],
+                }
+            }
+            for index, file_data in enumerate(files)
+        ]
+        
+        return ojsonify({
             "analyses": analyses,
             "total_files": len(files),
             "analyzed_files": len(analyses)
         })
 
+    except msgspec.ValidationError as e:
+        return ojsonify({"error": f"Missing or invalid data in request: {e}"}), 400
+    except msgspec.DecodeError:
+        return ojsonify({"error": "Invalid JSON format"}), 400
+    except Exception as e:
+        logger.error(f"Error in batch analysis: {e}")
+        return ojsonify({"error": "An internal server error occurred"}), 500
+
+# 离线批量分析支持的类型：(消息构建函数, max_tokens, temperature, response_format)
+BATCH_ANALYSIS_TYPES = {
+    'file_history': (build_file_history_messages, FILE_HISTORY_MAX_TOKENS, FILE_HISTORY_TEMPERATURE, prompts.FILE_HISTORY_RESPONSE_FORMAT),
+    'file_version_comparison': (build_file_version_comparison_messages, FILE_VERSION_COMPARISON_MAX_TOKENS, FILE_VERSION_COMPARISON_TEMPERATURE, prompts.FILE_VERSION_COMPARISON_RESPONSE_FORMAT),
+}
+
+# batch id -> (分析类型, 各请求的 analysis_context 列表)，保存在 SQLite 中供所有 worker 查询
+batch_jobs = BatchJobStore(os.environ.get("BATCH_JOBS_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_jobs.db')))
+
+@app.route('/submit_batch', methods=['POST'])
+def submit_batch():
+    """通过 OpenAI Batch API 提交非实时的文件历史/版本比较批量分析"""
+    batch_provider = model_manager.get_batch_provider()
+    if not batch_provider:
+        return ojsonify({"error": "Batch analysis requires the OpenAI provider"}), 503
+
+    try:
+        data = request.get_json()
+        if not data or 'items' not in data:
+            return ojsonify({"error": "Missing 'items' in request"}), 400
+        
+        analysis_type = data.get('analysis_type')
+        if analysis_type not in BATCH_ANALYSIS_TYPES:
+            return ojsonify({"error": f"Invalid analysis_type: {analysis_type}. Available: {list(BATCH_ANALYSIS_TYPES.keys())}"}), 400
+        
+        items = data['items']
+        if not isinstance(items, list) or not items:
+            return ojsonify({"error": "'items' must be a non-empty array"}), 400
+        
+        build_messages, max_tokens, temperature, response_format = BATCH_ANALYSIS_TYPES[analysis_type]
+        batch_requests = []
+        contexts = []
+        for index, item in enumerate(items):
+            payload = json.loads(item.get('file_diff', '{}'))
+            contexts.append(item.get('analysis_context', '未知文件'))
+            batch_requests.append((f"item-{index}", build_messages(payload)))
+        
+        batch_id = batch_provider.submit_batch(batch_requests, max_tokens=max_tokens, temperature=temperature, response_format=response_format)
+        batch_jobs.save(batch_id, analysis_type, contexts)
+        logger.info(f"Submitted {analysis_type} batch {batch_id} with {len(items)} items")
+        
+        return ojsonify({
+            "batch_id": batch_id,
+            "total_items": len(items)
+        }), 202
+
+    except (json.JSONDecodeError, KeyError, AttributeError) as e:
+        logger.error(f"Error parsing batch submission payload: {e}")
+        return ojsonify({"error": "Invalid payload for batch submission"}), 400
+    except Exception as e:
+        logger.error(f"Error submitting batch: {e}")
+        return ojsonify({"error": f"Failed to submit batch: {str(e)}"}), 500
+
+@app.route('/analyze_batch_async', methods=['POST'])
+def analyze_batch_async():
+    """通过 OpenAI Batch API 提交多文件差异分析，请求体与 /analyze_batch 相同"""
+    batch_provider = model_manager.get_batch_provider()
+    if not batch_provider:
+        return ojsonify({"error": "Batch analysis requires the OpenAI provider"}), 503
+
+    try:
+        files = _batch_request_decoder.decode(request.get_data()).files
+        
+        # 空 diff 无需调用AI，不提交到批量任务中
+        pending = [file_data for file_data in files if file_data.file_diff and file_data.file_diff.strip() != '']
+        if not pending:
+            return ojsonify({"error": "No files with changes to analyze"}), 400
+        
+        batch_requests = [
+            (f"item-{index}", build_analyze_diff_messages(file_data.analysis_context, file_data.file_diff))
+            for index, file_data in enumerate(pending)
+        ]
+        batch_id = batch_provider.submit_batch(batch_requests, max_tokens=ANALYZE_DIFF_MAX_TOKENS, temperature=ANALYZE_DIFF_TEMPERATURE)
+        batch_jobs.save(batch_id, 'analyze_diff', [file_data.analysis_context for file_data in pending])
+        logger.info(f"Submitted analyze_diff batch {batch_id} with {len(pending)} files")
+        
+        return ojsonify({
+            "batch_id": batch_id,
+            "total_files": len(files),
+            "submitted_files": len(pending)
+        }), 202
+
+    except msgspec.ValidationError as e:
+        return ojsonify({"error": f"Missing or invalid data in request: {e}"}), 400
+    except msgspec.DecodeError:
+        return ojsonify({"error": "Invalid JSON format"}), 400
+    except Exception as e:
+        logger.error(f"Error submitting diff batch: {e}")
+        return ojsonify({"error": f"Failed to submit batch: {str(e)}"}), 500
+
+@app.route('/batch_status/<batch_id>', methods=['GET'])
+@app.route('/analyze_batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    """查询离线批量分析的状态，完成后返回各项的分析结果"""
+    batch_provider = model_manager.get_batch_provider()
+    if not batch_provider:
+        return ojsonify({"error": "Batch analysis requires the OpenAI provider"}), 503
+
+    try:
+        status, results = batch_provider.get_batch_results(batch_id)
+        if results is None:
+            return ojsonify({"batch_id": batch_id, "status": status}), 200
+        
+        analysis_type, contexts = batch_jobs.get(batch_id) or (None, [])
+        analyses = []
+        for custom_id, ai_summary in sorted(results.items(), key=lambda item: int(item[0].split('-')[-1])):
+            index = int(custom_id.split('-')[-1])
+            analysis_context = contexts[index] if index < len(contexts) else custom_id
+            if ai_summary is None:
+                ai_summary = "AI分析时发生错误：批量请求未返回结果。"
+            elif analysis_type == 'file_history':
+                ai_summary = validate_file_history_summary(ai_summary, analysis_context)
+            analyses.append({
+                "analysis_context": analysis_context,
+                "analysis": {
+                    "summary": ai_summary,
+                }
+            })
+        
+        return ojsonify({
+            "batch_id": batch_id,
+            "status": status,
+            "analyses": analyses
+        }), 200
+
     except Exception as e:
-        print(f"Error in batch analysis: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+        logger.error(f"Error retrieving batch {batch_id}: {e}")
+        return ojsonify({"error": f"Failed to retrieve batch status: {str(e)}"}), 500
 
 if __name__ == '__main__':
-    print("🎯 Starting AI Analysis Service...")
-    print(f"🤖 Using AI Provider: {model_manager.get_current_provider().get_provider_name() if model_manager.is_available() else 'None'}")
-    app.run(host='0.0.0.0', port=5111, debug=True) 
\ No newline at end of file
+    logger.info("🎯 Starting AI Analysis Service...")
+    logger.info(f"🤖 Using AI Provider: {model_manager.get_current_provider().get_provider_name() if model_manager.is_available() else 'None'}")
+    logger.info("💡 Development server only; for production run: gunicorn -c gunicorn.conf.py server:app")
+    # 每个请求在独立线程中处理，阻塞的AI接口调用不会阻塞其他请求
+    # 调试模式（交互式调试器和自动重载）仅在 FLASK_DEBUG=1 时开启
+    app.run(host='0.0.0.0', port=5111, debug=os.environ.get("FLASK_DEBUG") == "1", threaded=True) 
\ No newline at end of file
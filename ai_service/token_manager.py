@@ -1,8 +1,131 @@
 # ai_service/token_manager.py
 
+import os
 import json
 import re
+import logging
+import threading
 from typing import List, Dict, Any, Tuple
+from cachetools import LRUCache
+
+logger = logging.getLogger('ai_service')
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 未安装时退化为按字符估算
+    tiktoken = None
+
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# 模型名前缀 -> tiktoken 编码（按顺序匹配，更具体的前缀在前）；Deepseek 没有公开的 tiktoken 编码，按 cl100k_base 近似
+_ENCODING_BY_MODEL_PREFIX = (
+    ('gpt-4.1', 'o200k_base'),
+    ('gpt-4o', 'o200k_base'),
+    ('gpt-4', 'cl100k_base'),
+)
+
+# 编码器在进程内只加载一次（加载词表约需 100ms），所有 TokenManager 实例共享
+_encoders = {}
+_unavailable_encodings = set()
+_encoders_lock = threading.Lock()
+
+def get_encoding_name(model_name: str = None) -> str:
+    """返回模型对应的 tiktoken 编码名称"""
+    if model_name:
+        for prefix, encoding_name in _ENCODING_BY_MODEL_PREFIX:
+            if model_name.startswith(prefix):
+                return encoding_name
+    return DEFAULT_ENCODING_NAME
+
+def get_encoding(model_name: str = None):
+    """懒加载模型对应的 tiktoken 编码器，不可用时返回 None"""
+    if tiktoken is None:
+        return None
+    
+    encoding_name = get_encoding_name(model_name)
+    encoding = _encoders.get(encoding_name)
+    if encoding is not None or encoding_name in _unavailable_encodings:
+        return encoding
+    
+    with _encoders_lock:
+        if encoding_name not in _encoders and encoding_name not in _unavailable_encodings:
+            try:
+                _encoders[encoding_name] = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                logger.warning(f"Failed to load tiktoken encoding {encoding_name}, falling back to character estimates: {e}")
+                _unavailable_encodings.add(encoding_name)
+    return _encoders.get(encoding_name)
+
+# diff 中需要优先保留的行：hunk 头（@@ ... @@）、文件头（+++/---）以及新增/删除行
+_PRIORITY_RE = re.compile(r'@@.*@@|\+|-')
+
+# token 计数缓存：同一段内容（如同一个 diff）在一次优化过程中会被多次计数，
+# 以 (长度, 哈希) 为键而不是保留文本本身，避免缓存长期持有大段 diff
+_TOKEN_COUNT_CACHE_SIZE = 4096
+_token_count_cache = LRUCache(maxsize=_TOKEN_COUNT_CACHE_SIZE)
+_token_count_lock = threading.Lock()
+
+def _encode_len(text: str, encoding) -> int:
+    """返回文本在指定编码器下的 token 数（带缓存），编码器为 None 时按 1 token ≈ 4 字符估算"""
+    if encoding is None:
+        return len(text) // 4
+    
+    key = (encoding.name, len(text), hash(text))
+    with _token_count_lock:
+        count = _token_count_cache.get(key)
+    if count is None:
+        count = len(encoding.encode(text, disallowed_special=()))
+        with _token_count_lock:
+            _token_count_cache[key] = count
+    return count
+
+def _prime_token_counts(texts: List[str], encoding):
+    """
+    批量计算多段文本的 token 数并写入缓存：encode_ordinary_batch 在 Rust 线程池中并行分词，
+    只跨越一次 Python/Rust 边界。已缓存的文本会被跳过，编码器为 None 时不做任何事
+    """
+    if encoding is None:
+        return
+    
+    pending = {}
+    with _token_count_lock:
+        for text in texts:
+            if not text:
+                continue
+            key = (encoding.name, len(text), hash(text))
+            if key not in _token_count_cache:
+                pending[key] = text
+    
+    # 只有一段文本时没有并行收益，留给 _encode_len 按需计算
+    if len(pending) < 2:
+        return
+    
+    token_lists = encoding.encode_ordinary_batch(list(pending.values()), num_threads=os.cpu_count() or 1)
+    with _token_count_lock:
+        for key, tokens in zip(pending, token_lists):
+            _token_count_cache[key] = len(tokens)
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    """
+    将文本截断到指定 token 预算内：保留开头和结尾各一半，省略中间部分
+    """
+    if not text:
+        return text
+    
+    encoding = get_encoding()
+    if encoding is None:
+        # 没有分词器时按 1 token ≈ 4 字符近似
+        max_chars = max_tokens * 4
+        if len(text) <= max_chars:
+            return text
+        half = max_chars // 2
+        return f"{text[:half]}\n...[已省略约 {(len(text) - max_chars) // 4} tokens]...\n{text[-half:]}"
+    
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    half = max_tokens // 2
+    return f"{encoding.decode(tokens[:half])}\n...[已省略 {len(tokens) - max_tokens} tokens]...\n{encoding.decode(tokens[-half:])}"
 
 class TokenManager:
     """
@@ -24,6 +147,7 @@ class TokenManager:
     
     def __init__(self, model_name: str = 'deepseek-v3'):
         self.model_name = model_name
+        self.encoding = get_encoding(model_name)
         self.max_tokens = self.MODEL_LIMITS.get(model_name, 32768)
         self.available_tokens = self.max_tokens - self.RESPONSE_TOKENS
         
@@ -32,40 +156,16 @@ class TokenManager:
             # 为超大模型保留更多响应空间
             self.RESPONSE_TOKENS = 2000
             self.available_tokens = self.max_tokens - self.RESPONSE_TOKENS
-            print(f"Large context model detected: {model_name}, adjusted response tokens to {self.RESPONSE_TOKENS}")
+            logger.info(f"Large context model detected: {model_name}, adjusted response tokens to {self.RESPONSE_TOKENS}")
         
     def estimate_tokens(self, text: str) -> int:
         """
-        估算文本的 token 数量
-        简化算法：大约 1 token = 4 字符（对中文和代码都有一定准确性）
+        计算文本的 token 数量
+        使用模型对应的 tiktoken 编码精确计数；分词器不可用时按 1 token ≈ 4 字符估算
         """
         if not text:
             return 0
-        
-        # 基础字符计数
-        char_count = len(text)
-        
-        # 对代码内容进行调整（代码通常 token 密度更高）
-        if self._is_code_content(text):
-            # 代码的 token 密度通常是 1 token ≈ 3 字符
-            return int(char_count / 3)
-        else:
-            # 普通文本的 token 密度是 1 token ≈ 4 字符
-            return int(char_count / 4)
-    
-    def _is_code_content(self, text: str) -> bool:
-        """
-        判断文本是否为代码内容
-        """
-        code_indicators = [
-            '```', 'function', 'class ', 'def ', 'import ', 'require',
-            '{}', '[]', '()', '=>', '->', '::',
-            '+++', '---', '@@', 'diff'
-        ]
-        
-        # 如果包含多个代码指示符，认为是代码
-        indicator_count = sum(1 for indicator in code_indicators if indicator in text)
-        return indicator_count >= 2
+        return _encode_len(text, self.encoding)
     
     def optimize_file_analysis_data(self, file_analysis_data: List[Dict]) -> List[Dict]:
         """
@@ -83,31 +183,47 @@ class TokenManager:
         if available_for_files < 100:
             return []
         
+        # 先计算每个文件的 token 数，再统一分配预算，避免靠前的大文件占满预算导致后面的文件被丢弃
+        _prime_token_counts([file_data.get('diffContent', '') for file_data in file_analysis_data], self.encoding)
+        file_costs = [self._estimate_file_tokens(file_data) for file_data in file_analysis_data]
+        file_budgets = self._allocate_file_budgets(file_costs, available_for_files)
+        
         optimized_files = []
-        used_tokens = 0
         
-        for file_data in file_analysis_data:
-            # 优化单个文件的内容
-            optimized_file = self._optimize_single_file(file_data, available_for_files - used_tokens)
+        for file_data, file_cost, file_budget in zip(file_analysis_data, file_costs, file_budgets):
+            # 将单个文件压缩到分配的预算内
+            optimized_file = self._optimize_single_file(file_data, file_budget, current_tokens=file_cost)
+            if not optimized_file:
+                continue
             
-            if optimized_file:
-                file_tokens = self._estimate_file_tokens(optimized_file)
-                
-                # 检查是否还有足够的空间
-                if used_tokens + file_tokens <= available_for_files:
-                    optimized_files.append(optimized_file)
-                    used_tokens += file_tokens
-                else:
-                    # 如果没有空间了，尝试进一步压缩
-                    remaining_tokens = available_for_files - used_tokens
-                    if remaining_tokens > 50:  # 至少需要 50 tokens 才有意义
-                        compressed_file = self._compress_file_content(optimized_file, remaining_tokens)
-                        if compressed_file:
-                            optimized_files.append(compressed_file)
-                    break
+            # 常规压缩按字符比例估算，结果仍可能略超出预算，此时改用激进压缩（未压缩的文件已知在预算内）
+            if optimized_file is not file_data and self._estimate_file_tokens(optimized_file) > file_budget:
+                optimized_file = self._compress_file_content(optimized_file, file_budget)
+                if not optimized_file:
+                    continue
+            
+            optimized_files.append(optimized_file)
         
         return optimized_files
     
+    @staticmethod
+    def _allocate_file_budgets(file_costs: List[int], total_budget: int) -> List[int]:
+        """
+        按最大最小公平原则分配 token 预算：从小到大依次处理，不超过平均份额的文件获得全部所需，
+        剩余预算由更大的文件平分。总需求不超过预算时每个文件都获得全部所需
+        """
+        budgets = [0] * len(file_costs)
+        remaining_budget = total_budget
+        remaining_files = len(file_costs)
+        
+        for index in sorted(range(len(file_costs)), key=file_costs.__getitem__):
+            share = remaining_budget // remaining_files
+            budgets[index] = min(file_costs[index], share)
+            remaining_budget -= budgets[index]
+            remaining_files -= 1
+        
+        return budgets
+    
     def _estimate_base_prompt_tokens(self) -> int:
         """
         估算基础 prompt 的 token 数（不包括文件内容的部分）
@@ -133,31 +249,31 @@ class TokenManager:
         
         return tokens
     
-    def _optimize_single_file(self, file_data: Dict, available_tokens: int) -> Dict:
+    def _optimize_single_file(self, file_data: Dict, available_tokens: int, current_tokens: int = None) -> Dict:
         """
-        优化单个文件的内容
+        优化单个文件的内容（无需压缩时直接返回原字典，只在修改内容时创建新字典）
+        current_tokens 为已计算好的文件 token 数，未提供时重新计算
         """
-        if available_tokens < 50:  # 太少的 token 无法有效分析
-            return None
-        
-        optimized_file = file_data.copy()
         diff_content = file_data.get('diffContent', '')
         
-        if not diff_content:
-            return optimized_file
-        
         # 计算当前文件的 token 数
-        current_tokens = self._estimate_file_tokens(file_data)
+        if current_tokens is None:
+            current_tokens = self._estimate_file_tokens(file_data)
         
         if current_tokens <= available_tokens:
-            return optimized_file
+            return file_data
+        
+        if available_tokens < 50:  # 太少的 token 无法有效压缩
+            return None
+        
+        if not diff_content:
+            return file_data
         
         # 需要压缩 diff 内容
         target_diff_tokens = available_tokens - 30  # 为文件路径等其他信息预留 30 tokens
         optimized_diff = self._compress_diff_content(diff_content, target_diff_tokens)
-        optimized_file['diffContent'] = optimized_diff
         
-        return optimized_file
+        return {**file_data, 'diffContent': optimized_diff}
     
     def _compress_file_content(self, file_data: Dict, max_tokens: int) -> Dict:
         """
@@ -166,15 +282,13 @@ class TokenManager:
         if max_tokens < 30:
             return None
         
-        compressed_file = file_data.copy()
         diff_content = file_data.get('diffContent', '')
         
         # 极度压缩的 diff 内容
         target_diff_tokens = max_tokens - 20
         compressed_diff = self._compress_diff_content(diff_content, target_diff_tokens, aggressive=True)
-        compressed_file['diffContent'] = compressed_diff
         
-        return compressed_file
+        return {**file_data, 'diffContent': compressed_diff}
     
     def _compress_diff_content(self, diff_content: str, target_tokens: int, aggressive: bool = False) -> str:
         """
@@ -191,45 +305,38 @@ class TokenManager:
         # 计算压缩比例
         compression_ratio = target_tokens / current_tokens
         
+        # 只在这里拆分一次行，两种压缩方式共用
+        lines = diff_content.splitlines()
+        
         if aggressive:
             # 激进压缩：只保留最重要的变更行
-            return self._aggressive_compress_diff(diff_content, target_tokens)
+            return self._aggressive_compress_diff(lines, target_tokens)
         else:
             # 常规压缩：保留结构，截断内容
-            return self._regular_compress_diff(diff_content, compression_ratio)
+            target_chars = int(len(diff_content) * compression_ratio)
+            return self._regular_compress_diff(lines, target_chars)
     
-    def _regular_compress_diff(self, diff_content: str, compression_ratio: float) -> str:
+    def _regular_compress_diff(self, lines: List[str], target_chars: int) -> str:
         """
-        常规 diff 压缩：保留重要信息，截断冗余内容
+        常规 diff 压缩：保留重要信息，截断冗余内容到 target_chars 个字符以内
         """
-        lines = diff_content.split('\n')
-        
-        # 保留的行类型优先级
-        priority_patterns = [
-            r'^@@.*@@',  # diff header
-            r'^\+\+\+',  # file header
-            r'^---',     # file header
-            r'^\+.*',    # added lines
-            r'^-.*',     # removed lines
-        ]
-        
         important_lines = []
         context_lines = []
+        # 重要行拼接后的长度（含换行符），在分类时累加，避免重复 join 整个列表
+        important_chars = 0
         
         for line in lines:
-            is_important = any(re.match(pattern, line) for pattern in priority_patterns)
+            # 先用首字符筛掉绝大多数上下文行，只有可能匹配的行才进入正则
+            is_important = line[:1] in ('+', '-', '@') and _PRIORITY_RE.match(line) is not None
             if is_important:
                 important_lines.append(line)
+                important_chars += len(line) + 1
             else:
                 context_lines.append(line)
         
-        # 计算可以保留多少内容
-        total_chars = len('\n'.join(lines))
-        target_chars = int(total_chars * compression_ratio)
-        
         # 先保留重要行
-        result_lines = important_lines[:]
-        current_chars = len('\n'.join(result_lines))
+        result_lines = important_lines
+        current_chars = important_chars - 1 if important_lines else 0
         
         # 如果还有空间，添加部分上下文行
         for line in context_lines:
@@ -247,16 +354,24 @@ class TokenManager:
         
         return result
     
-    def _aggressive_compress_diff(self, diff_content: str, target_tokens: int) -> str:
+    def _aggressive_compress_diff(self, lines: List[str], target_tokens: int) -> str:
         """
         激进 diff 压缩：只保留最关键的变更信息
         """
-        lines = diff_content.split('\n')
-        
-        # 提取关键信息
-        added_lines = [line for line in lines if line.startswith('+') and not line.startswith('+++')]
-        removed_lines = [line for line in lines if line.startswith('-') and not line.startswith('---')]
-        headers = [line for line in lines if line.startswith('@@')]
+        # 一次遍历提取关键信息
+        added_lines = []
+        removed_lines = []
+        headers = []
+        for line in lines:
+            first = line[:1]
+            if first == '+':
+                if not line.startswith('+++'):
+                    added_lines.append(line)
+            elif first == '-':
+                if not line.startswith('---'):
+                    removed_lines.append(line)
+            elif first == '@' and line.startswith('@@'):
+                headers.append(line)
         
         # 构建简化的 diff
         summary_parts = []
@@ -287,18 +402,18 @@ class TokenManager:
         
         return result
     
-    def validate_prompt_size(self, messages: List[Dict]) -> Tuple[bool, int, str]:
+    def validate_prompt_size(self, messages: List[Dict], precomputed_tokens: int = None) -> Tuple[bool, int, str]:
         """
         验证 prompt 大小是否在模型限制内
+        precomputed_tokens 为调用方构建消息时已累计的 token 数，提供时不再重新分词
         
         Returns:
             (is_valid, estimated_tokens, recommendation)
         """
-        total_tokens = 0
-        
-        for message in messages:
-            content = message.get('content', '')
-            total_tokens += self.estimate_tokens(content)
+        if precomputed_tokens is not None:
+            total_tokens = precomputed_tokens
+        else:
+            total_tokens = sum(self.estimate_tokens(message.get('content', '')) for message in messages)
         
         is_valid = total_tokens <= self.available_tokens
         
@@ -311,14 +426,17 @@ class TokenManager:
         
         return is_valid, total_tokens, recommendation
     
-    def get_optimization_stats(self, original_files: List[Dict], optimized_files: List[Dict]) -> Dict:
+    def get_optimization_stats(self, original_files: List[Dict], optimized_files: List[Dict], original_costs: List[int] = None) -> Dict:
         """
         获取优化统计信息
+        original_costs 为已计算好的原始文件 token 数列表，提供时不再重新计算
         """
         original_count = len(original_files)
         optimized_count = len(optimized_files)
         
-        original_tokens = sum(self._estimate_file_tokens(f) for f in original_files)
+        if original_costs is None:
+            original_costs = [self._estimate_file_tokens(f) for f in original_files]
+        original_tokens = sum(original_costs)
         optimized_tokens = sum(self._estimate_file_tokens(f) for f in optimized_files)
         
         return {
@@ -1,24 +1,63 @@
 import os
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+
+# Conversion is I/O bound (file reads/writes release the GIL), so threads overlap disk requests
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Directories that are never descended into (VCS metadata, dependencies, build output)
+SKIP_DIRS = {'.git', 'node_modules', 'dist', 'out', '.venv', 'venv', '__pycache__'}
+
+# Known binary formats are skipped without opening the file
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.ico', '.pdf', '.zip', '.gz', '.vsix',
+    '.whl', '.pyc', '.so', '.dll', '.exe', '.node', '.woff', '.woff2', '.ttf'
+}
+
+# Like git and grep, treat a NUL byte within the first 8 KiB as a binary file
+BINARY_SNIFF_BYTES = 8192
+
+def convert_file(file_path):
+    """
+    Convert CRLF line endings to LF in a single file.
+    The file is memory-mapped and scanned first, so files without CRLF are never copied or rewritten.
+    Binary files are skipped.
+    """
+    if os.path.splitext(file_path)[1].lower() in BINARY_EXTENSIONS:
+        return False
+
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b'\x00', 0, BINARY_SNIFF_BYTES) != -1 or mm.find(b'\r\n') == -1:
+                return False
+            content = mm[:]
+
+    # When every CR is part of a CRLF pair, deleting CR bytes is equivalent to the replace and cheaper
+    if content.count(b'\r') == content.count(b'\r\n'):
+        new_content = content.translate(None, b'\r')
+    else:
+        new_content = content.replace(b'\r\n', b'\n')
+
+    with open(file_path, 'wb') as f:
+        f.write(new_content)
+    return True
 
 def convert_line_endings(directory):
     """
     Recursively convert CRLF line endings to LF in all files within the given directory.
     """
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            # Convert CRLF to LF
-            new_content = content.replace(b'\r\n', b'\n')
-            
-            # Only write back if changes were made
-            if new_content != content:
-                with open(file_path, 'wb') as f:
-                    f.write(new_content)
+    file_paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        file_paths.extend(os.path.join(root, file) for file in files)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Report from the main thread so output lines from different workers don't interleave
+        for file_path, converted in zip(file_paths, executor.map(convert_file, file_paths)):
+            if converted:
                 print(f"Converted line endings in: {file_path}")
 
 # Specify the directory you want to start the conversion from
 project_directory = '.'  # Current directory
-convert_line_endings(project_directory)
\ No newline at end of file
+convert_line_endings(project_directory)